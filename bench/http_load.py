@@ -0,0 +1,309 @@
+"""HTTP API benchmark against a throwaway SQLite database.
+
+Runs server/app.py in-process through Flask's test client, so no Postgres,
+sockets or running server are needed, and drives the main scenarios with
+concurrent worker threads:
+
+    register -> login -> create_room -> join -> post -> history -> list_rooms
+
+Each scenario reports throughput and a latency histogram and percentiles.
+Results are printed and saved as JSON for comparing runs.
+
+    python bench/http_load.py --users 200 --workers 8
+    python bench/http_load.py --database-url sqlite:////tmp/chat.db --bcrypt-rounds 4
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99, "p999": 0.999}
+# Upper bounds of the latency histogram buckets, in milliseconds.
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class Scenario:
+    """Latencies and failures of one endpoint scenario."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+            if not ok:
+                self.errors += 1
+
+    def report(self) -> dict:
+        latencies = sorted(self.latencies)
+        histogram = {f"<={bound}ms": 0 for bound in HISTOGRAM_BOUNDS_MS}
+        histogram["inf"] = 0
+        for seconds in latencies:
+            ms = seconds * 1000
+            bucket = next((f"<={b}ms" for b in HISTOGRAM_BOUNDS_MS if ms <= b), "inf")
+            histogram[bucket] += 1
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "requests_per_second": (
+                round(len(latencies) / self.seconds, 1) if self.seconds else 0.0
+            ),
+            "latency_ms": {
+                name: round(
+                    latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000,
+                    3,
+                )
+                for name, q in PERCENTILES.items()
+                if latencies
+            },
+            "histogram_ms": histogram,
+        }
+
+
+class HttpBenchmark:
+    def __init__(self, args: argparse.Namespace, app) -> None:
+        self.args = args
+        self.app = app
+        self.local = threading.local()
+        self.tokens: list[str] = []
+        self.room_ids: list[int] = []
+        self.scenarios: dict[str, Scenario] = {}
+
+    @property
+    def client(self):
+        # Test clients keep cookies and state, so each worker thread gets its own.
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def call(self, scenario: Scenario, method: str, url: str, expected: int, **kwargs):
+        started = time.perf_counter()
+        response = self.client.open(url, method=method, **kwargs)
+        scenario.record(time.perf_counter() - started, response.status_code == expected)
+        return response
+
+    def run_scenario(self, name: str, jobs: list) -> list:
+        """Run `jobs` (callables taking the Scenario) on the worker pool."""
+        scenario = self.scenarios[name] = Scenario(name)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(self.args.workers) as pool:
+            results = list(pool.map(lambda job: job(scenario), jobs))
+        scenario.seconds = time.perf_counter() - started
+        print(
+            f"{name}: {len(scenario.latencies)} requests in {scenario.seconds:.2f}s"
+            f" ({scenario.errors} errors)"
+        )
+        return results
+
+    def auth(self, user: int) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[user]}"}
+
+    def run(self) -> dict:
+        args = self.args
+        users = range(args.users)
+
+        def register(user):
+            return lambda s: self.call(
+                s,
+                "POST",
+                "/register",
+                201,
+                json={"username": f"bench{user}", "password": "bench-password"},
+            ).get_json()
+
+        self.run_scenario("register", [register(user) for user in users])
+
+        def login(user):
+            return lambda s: self.call(
+                s,
+                "POST",
+                "/login",
+                200,
+                json={"username": f"bench{user}", "password": "bench-password"},
+            ).get_json()["token"]
+
+        self.tokens = self.run_scenario("login", [login(user) for user in users])
+
+        def create_room(user):
+            return lambda s: self.call(
+                s,
+                "POST",
+                "/rooms",
+                201,
+                json={"name": f"bench room {user}", "timeout_minutes": 60},
+                headers=self.auth(user),
+            ).get_json()["room_id"]
+
+        self.room_ids = self.run_scenario(
+            "create_room", [create_room(user) for user in range(args.rooms)]
+        )
+
+        def room_of(user: int) -> int:
+            return self.room_ids[user % len(self.room_ids)]
+
+        def join(user):
+            return lambda s: self.call(
+                s,
+                "POST",
+                "/rooms/join",
+                200,
+                json={"room_id": room_of(user)},
+                headers=self.auth(user),
+            )
+
+        self.run_scenario("join", [join(user) for user in users])
+
+        def post(user, n):
+            return lambda s: self.call(
+                s,
+                "POST",
+                f"/rooms/{room_of(user)}/messages",
+                201,
+                json={"content": f"message {n} from bench{user}"},
+                headers=self.auth(user),
+            )
+
+        self.run_scenario(
+            "post",
+            [post(user, n) for n in range(args.messages) for user in users],
+        )
+
+        def history(user):
+            return lambda s: self.call(
+                s,
+                "GET",
+                f"/rooms/{room_of(user)}/messages",
+                200,
+                headers=self.auth(user),
+            )
+
+        self.run_scenario(
+            "history", [history(user) for _ in range(args.reads) for user in users]
+        )
+
+        def list_rooms(user):
+            return lambda s: self.call(s, "GET", "/rooms", 200)
+
+        self.run_scenario(
+            "list_rooms",
+            [list_rooms(user) for _ in range(args.reads) for user in users],
+        )
+        return self.report()
+
+    def report(self) -> dict:
+        from database import DATABASE_URI, DB_MAX_OVERFLOW, DB_POOL_SIZE
+        from hashing import BCRYPT_ROUNDS
+
+        return {
+            "target": "http",
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "config": {
+                "database": DATABASE_URI.partition("://")[0],
+                "users": self.args.users,
+                "rooms": self.args.rooms,
+                "messages_per_user": self.args.messages,
+                "reads_per_user": self.args.reads,
+                "workers": self.args.workers,
+                "db_pool_size": DB_POOL_SIZE,
+                "db_max_overflow": DB_MAX_OVERFLOW,
+                "bcrypt_rounds": BCRYPT_ROUNDS,
+            },
+            "scenarios": {
+                name: scenario.report() for name, scenario in self.scenarios.items()
+            },
+        }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_app(args: argparse.Namespace):
+    """Import the API configured for a throwaway database.
+
+    The environment has to be in place before the server modules are imported,
+    since they read it at import time.
+    """
+    from cryptography.fernet import Fernet
+
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        path = os.path.join(tempfile.mkdtemp(prefix="chat-bench-"), "chat.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+    os.environ.setdefault("SESSION_SECRET", "http-load-benchmark")
+
+    sys.path.append(os.path.join(ROOT, "server"))
+    os.chdir(os.path.join(ROOT, "server"))
+    from app import app
+    from database import init_db
+    from server import set_embedded_gateway
+
+    # Only the HTTP API is measured; creating rooms must not open sockets.
+    set_embedded_gateway(False)
+    init_db()
+    return app
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=5, help="posts per user")
+    parser.add_argument("--reads", type=int, default=5, help="reads per user")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--database-url", help="SQLAlchemy URL (default: a new SQLite file)"
+    )
+    parser.add_argument(
+        "--bcrypt-rounds", type=int, help="override BCRYPT_ROUNDS for faster runs"
+    )
+    parser.add_argument("--output", help="JSON results path (default: bench/results/)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    app = load_app(args)
+    results = HttpBenchmark(args, app).run()
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"http-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
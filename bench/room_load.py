@@ -0,0 +1,329 @@
+"""Load generator and fan-out latency benchmark for the chat servers.
+
+Starts a server in a subprocess, connects N clients spread over M rooms, and
+has every client send chat lines at a fixed rate. Each line carries its send
+time, so every delivery measures end-to-end fan-out latency. Results are
+printed and saved as JSON for comparing runs.
+
+    python bench/room_load.py --target gateway --clients 200 --rooms 10 --rate 2
+    python bench/room_load.py --target global --clients 50 --rate 1
+
+`gateway` is server/server.py (one asyncio loop, many rooms) and `global` is
+src/server.py (a thread per client, one room on port 1234).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT, "server"))
+os.environ.setdefault("SESSION_SECRET", "room-load-benchmark")
+from protocol import RECV_BUFFER_SIZE, FrameDecoder, FrameType, encode_frame
+from tokens import issue_token
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+GLOBAL_SERVER_PORT = 1234
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99, "p999": 0.999}
+
+
+class ProcessSampler:
+    """CPU time, RSS and thread count of the server process (psutil or /proc)."""
+
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self.process = psutil.Process(pid) if psutil else None
+        self.max_rss = 0
+        self.max_threads = 0
+
+    def cpu_seconds(self) -> float:
+        if self.process:
+            times = self.process.cpu_times()
+            return times.user + times.system
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def sample(self) -> None:
+        if self.process:
+            rss, threads = self.process.memory_info().rss, self.process.num_threads()
+        else:
+            status = {}
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    status[key] = value.split()
+            rss, threads = int(status["VmRSS"][0]) * 1024, int(status["Threads"][0])
+        self.max_rss = max(self.max_rss, rss)
+        self.max_threads = max(self.max_threads, threads)
+
+
+class LoadClient:
+    def __init__(self, index: int, room_id: int, bench: "Benchmark") -> None:
+        self.index = index
+        self.room_id = room_id
+        self.bench = bench
+        self.name = f"load{index}"
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def connect(self, host: str, port: int) -> None:
+        for attempt in range(50):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(host, port)
+                break
+            except OSError:
+                await asyncio.sleep(0.1 * (attempt + 1))
+        else:
+            raise ConnectionError(f"{self.name} could not connect to {host}:{port}")
+        self.writer.write(
+            encode_frame(
+                FrameType.HELLO,
+                self.room_id,
+                self.name,
+                issue_token(self.index + 1, self.name),
+            )
+        )
+        await self.writer.drain()
+
+    async def receive(self) -> None:
+        decoder = FrameDecoder()
+        bench = self.bench
+        try:
+            while data := await self.reader.read(RECV_BUFFER_SIZE):
+                now = time.perf_counter_ns()
+                for frame in decoder.feed(data):
+                    if frame.type != FrameType.CHAT:
+                        continue
+                    sent_ns = int(frame.payload.split(b" ", 1)[0])
+                    if sent_ns >= bench.measure_from_ns:
+                        bench.latencies_ns.append(now - sent_ns)
+        except ConnectionError:
+            pass
+        bench.disconnected.add(self.index)
+
+    async def send(self, rate: float, size: int, stop_at: float) -> None:
+        interval = 1 / rate
+        padding = b"x" * size
+        await asyncio.sleep(random.random() * interval)
+        next_send = time.perf_counter()
+        while next_send < stop_at:
+            now_ns = time.perf_counter_ns()
+            self.writer.write(
+                encode_frame(
+                    FrameType.CHAT,
+                    self.room_id,
+                    self.name,
+                    b"%d %s" % (now_ns, padding),
+                )
+            )
+            if now_ns >= self.bench.measure_from_ns:
+                self.bench.sent += 1
+                self.bench.expected += self.bench.room_sizes[self.room_id]
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self.bench.disconnected.add(self.index)
+                return
+            next_send += interval
+            await asyncio.sleep(max(next_send - time.perf_counter(), 0))
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.rooms = 1 if args.target == "global" else args.rooms
+        self.room_ids = [
+            0 if args.target == "global" else room + 1 for room in range(self.rooms)
+        ]
+        self.clients = [
+            LoadClient(index, self.room_ids[index % self.rooms], self)
+            for index in range(args.clients)
+        ]
+        self.room_sizes: dict[int, int] = {}
+        for client in self.clients:
+            self.room_sizes[client.room_id] = self.room_sizes.get(client.room_id, 0) + 1
+        self.latencies_ns: list[int] = []
+        self.sent = 0
+        self.disconnected: set[int] = set()
+        self.expected = 0
+        self.measure_from_ns = 1 << 62
+
+    def start_server(self) -> subprocess.Popen:
+        env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+        if self.args.target == "global":
+            command = [sys.executable, os.path.join(ROOT, "src", "server.py")]
+        else:
+            command = [
+                sys.executable,
+                os.path.join(ROOT, "bench", "run_gateway.py"),
+                str(self.args.port),
+            ]
+        return subprocess.Popen(
+            command,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=None if self.args.verbose else subprocess.DEVNULL,
+        )
+
+    async def run(self) -> dict:
+        args = self.args
+        port = GLOBAL_SERVER_PORT if args.target == "global" else args.port
+        server = self.start_server()
+        sampler = ProcessSampler(server.pid)
+        try:
+            await asyncio.sleep(args.startup)
+            if server.poll() is not None:
+                raise RuntimeError(
+                    f"{args.target} server exited with {server.returncode}; "
+                    "rerun with --verbose to see why"
+                )
+            started = time.perf_counter()
+            for first in range(0, len(self.clients), 100):
+                await asyncio.gather(
+                    *(
+                        client.connect("127.0.0.1", port)
+                        for client in self.clients[first : first + 100]
+                    )
+                )
+            connect_seconds = time.perf_counter() - started
+            receivers = [asyncio.create_task(c.receive()) for c in self.clients]
+
+            send_start = time.perf_counter()
+            stop_at = send_start + args.warmup + args.duration
+            senders = [
+                asyncio.create_task(c.send(args.rate, args.size, stop_at))
+                for c in self.clients
+            ]
+            await asyncio.sleep(args.warmup)
+            self.measure_from_ns = time.perf_counter_ns()
+            cpu_start = sampler.cpu_seconds()
+            measure_start = time.perf_counter()
+            while time.perf_counter() < stop_at:
+                sampler.sample()
+                await asyncio.sleep(0.25)
+            await asyncio.gather(*senders)
+            measured = time.perf_counter() - measure_start
+            cpu_seconds = sampler.cpu_seconds() - cpu_start
+            sampler.sample()
+            await asyncio.sleep(args.drain)
+            disconnected = len(self.disconnected)
+
+            for client in self.clients:
+                client.writer.close()
+            for receiver in receivers:
+                receiver.cancel()
+            await asyncio.gather(*receivers, return_exceptions=True)
+        finally:
+            server.terminate()
+            server.wait(5)
+
+        return self.report(
+            measured, cpu_seconds, connect_seconds, disconnected, sampler
+        )
+
+    def report(
+        self,
+        measured: float,
+        cpu_seconds: float,
+        connect_seconds: float,
+        disconnected: int,
+        sampler: ProcessSampler,
+    ) -> dict:
+        latencies = sorted(self.latencies_ns)
+        latency_ms = {
+            name: latencies[min(int(q * len(latencies)), len(latencies) - 1)] / 1e6
+            for name, q in PERCENTILES.items()
+            if latencies
+        }
+        if latencies:
+            latency_ms["max"] = latencies[-1] / 1e6
+        return {
+            "target": self.args.target,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "config": {
+                "clients": self.args.clients,
+                "rooms": self.rooms,
+                "rate_per_client": self.args.rate,
+                "payload_bytes": self.args.size,
+                "warmup_seconds": self.args.warmup,
+                "duration_seconds": self.args.duration,
+            },
+            "connect_seconds": round(connect_seconds, 3),
+            "clients_disconnected": disconnected,
+            "messages_sent": self.sent,
+            "messages_per_second": round(self.sent / measured, 1),
+            "deliveries": len(latencies),
+            "deliveries_expected": self.expected,
+            "deliveries_per_second": round(len(latencies) / measured, 1),
+            "latency_ms": {name: round(value, 3) for name, value in latency_ms.items()},
+            "server": {
+                "cpu_percent": round(100 * cpu_seconds / measured, 1),
+                "max_rss_mb": round(sampler.max_rss / (1 << 20), 1),
+                "max_threads": sampler.max_threads,
+            },
+        }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--target", choices=["gateway", "global"], default="gateway")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="messages per second per client"
+    )
+    parser.add_argument("--size", type=int, default=64, help="payload padding bytes")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--drain", type=float, default=1.0)
+    parser.add_argument("--startup", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=5101, help="gateway port")
+    parser.add_argument("--output", help="JSON results path (default: bench/results/)")
+    parser.add_argument("--verbose", action="store_true", help="show server stderr")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results = asyncio.run(Benchmark(args).run())
+    output = args.output or os.path.join(
+        RESULTS_DIR,
+        f"{args.target}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
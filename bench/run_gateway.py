@@ -0,0 +1,18 @@
+"""Runs the room gateway without a database for room_load.py: every room id is
+accepted and chat lines are relayed but not stored.
+
+    SESSION_SECRET=... python bench/run_gateway.py 5101
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+)
+from server import run_room_gateway, set_room_loader
+
+if __name__ == "__main__":
+    set_room_loader(lambda room_id: time.time() + 24 * 60 * 60)
+    run_room_gateway(int(sys.argv[1]))
@@ -1,3 +1,5 @@
+import os
+import sys
 import socket
 import asyncio
 import requests
@@ -6,33 +8,41 @@ import flet as ft
 from typing import NoReturn
 import warnings
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+)
+from protocol import RECV_BUFFER_SIZE, FrameDecoder, FrameType, encode_frame
+
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 API_BASE_URL = "http://localhost:5000"
 SERVER_HOST = "localhost"
 
 current_user_id = None
+session_token = None
 current_room_id = None
 socket_connection = None
+# url -> (ETag, decoded JSON body) of the last 200 response
+response_cache: dict[str, tuple[str, object]] = {}
 
 
 def listen_for_messages_from_server(page: ft.Page, message_box: ft.Column) -> None:
+    decoder = FrameDecoder()
     while True:
         try:
             print("Listening for messages...")
-            message = socket_connection.recv(1024).decode()
-            print(f"Received message: {message}")
-            if message:
-                sender = message.split("~")[0]
-                if sender == "SERVER":
-                    content = message.split("~")[1]
-                    print(f"Content: {content}")
-                else:
-                    content = message.split("~")[2]
+            data = socket_connection.recv(RECV_BUFFER_SIZE)
+            if not data:
+                print("Connection closed by server")
+                break
+            frames = decoder.feed(data)
+            for frame in frames:
+                sender, content = frame.sender, frame.text
                 print(f"Sender: {sender}, Content: {content}")
                 if content:
                     message_box.controls.append(ft.Text(f"{sender}: {content}"))
-                    page.update()
+            if frames:
+                page.update()
         except Exception as e:
             print(f"Error receiving message: {e}")
             break
@@ -155,27 +165,50 @@ def show_login_register_ui(page: ft.Page, visible_form: str | None) -> None:
 
 
 def login(username: str, password: str) -> bool:
-    global current_user_id
+    global current_user_id, session_token
     response = requests.post(
         f"{API_BASE_URL}/login", json={"username": username, "password": password}
     )
     if response.status_code == 200:
         current_user_id = response.json().get("id")
+        session_token = response.json().get("token")
         return True
     return False
 
 
 def register(username: str, password: str) -> bool:
-    global current_user_id
+    global current_user_id, session_token
     response = requests.post(
         f"{API_BASE_URL}/register", json={"username": username, "password": password}
     )
     if response.status_code == 201:
         current_user_id = response.json().get("id")
+        session_token = response.json().get("token")
         return True
     return False
 
 
+def auth_headers() -> dict[str, str]:
+    return {"Authorization": f"Bearer {session_token}"}
+
+
+def cached_get_json(url: str) -> object | None:
+    """GET a JSON resource, revalidating any cached copy with its ETag."""
+    cached = response_cache.get(url)
+    headers = auth_headers() if session_token else {}
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    response = requests.get(url, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached[1]
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    if etag := response.headers.get("ETag"):
+        response_cache[url] = (etag, data)
+    return data
+
+
 def show_main_menu_ui(page: ft.Page) -> None:
     dialog_content = ft.Column(
         [
@@ -290,9 +323,8 @@ def show_public_rooms_ui(page: ft.Page) -> None:
 
             show_public_rooms_ui(page)
 
-    response = requests.get(f"{API_BASE_URL}/rooms")
-    if response.status_code == 200:
-        rooms = response.json()
+    rooms = cached_get_json(f"{API_BASE_URL}/rooms")
+    if rooms is not None:
 
         dialog_content = ft.Column(
             [
@@ -388,7 +420,9 @@ def show_chat_ui(page: ft.Page, room_id: int, nickname: str) -> None:
         socket_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         socket_connection.connect((SERVER_HOST, room["port"]))
 
-        socket_connection.send(nickname.encode())
+        socket_connection.sendall(
+            encode_frame(FrameType.HELLO, room_id, nickname, session_token)
+        )
 
         messages = get_chat_messages(room_id)
         message_box = ft.Column(
@@ -411,8 +445,9 @@ def show_chat_ui(page: ft.Page, room_id: int, nickname: str) -> None:
 
     async def send_message(msg: str) -> None:
         if msg:
-            post_message(room_id, current_user_id, msg)
-            socket_connection.send(f"{nickname}~{msg}".encode())
+            socket_connection.sendall(
+                encode_frame(FrameType.CHAT, room_id, payload=msg)
+            )
             message_field.value = ""
             page.update()
 
@@ -452,11 +487,11 @@ def create_room(name: str, timeout_minutes: int, access_code: str) -> bool:
         f"{API_BASE_URL}/rooms",
         json={
             "name": name,
-            "admin_id": current_user_id,
             "timeout_minutes": timeout_minutes,
             "access_code": access_code,
             "is_private": True if access_code else False,
         },
+        headers=auth_headers(),
     )
     if response.status_code == 201:
         current_room_id = response.json().get("room_id")
@@ -469,10 +504,10 @@ def join_room(room_id: int, access_code: str | None) -> bool:
     response = requests.post(
         f"{API_BASE_URL}/rooms/join",
         json={
-            "user_id": current_user_id,
             "room_id": room_id,
             "access_code": access_code,
         },
+        headers=auth_headers(),
     )
     if response.status_code == 200:
         return True
@@ -480,18 +515,8 @@ def join_room(room_id: int, access_code: str | None) -> bool:
 
 
 def get_chat_messages(room_id: int) -> list[str]:
-    response = requests.get(f"{API_BASE_URL}/rooms/{room_id}/messages")
-    if response.status_code == 200:
-        return response.json()
-    return []
-
-
-def post_message(room_id: int, user_id: int, content: str) -> bool:
-    response = requests.post(
-        f"{API_BASE_URL}/rooms/{room_id}/messages",
-        json={"user_id": user_id, "content": content},
-    )
-    return response.status_code == 201
+    messages = cached_get_json(f"{API_BASE_URL}/rooms/{room_id}/messages")
+    return messages if messages is not None else []
 
 
 def main(page: ft.Page) -> None:
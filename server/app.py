@@ -1,16 +1,171 @@
 from dotenv import load_dotenv
 
 load_dotenv()
-from typing import Literal
-from flask import Flask, Response, request, jsonify
+import gzip
+import time
+from functools import wraps
+from typing import Callable, Literal
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flasgger import Swagger
 from auth import register_user, authenticate_user
-from room import create_room, join_room, get_public_rooms, get_room
-from message import send_message, get_room_messages
-from database import SessionLocal, User
+from database import begin_request_session, end_request_session
+from room import (
+    ROOM_PAGE_SIZE,
+    create_room,
+    join_room,
+    get_public_rooms,
+    get_room,
+    has_room_access,
+    invalidate_room,
+    load_active_room,
+)
+from message import (
+    MESSAGE_PAGE_SIZE,
+    send_message,
+    get_room_messages,
+    iter_room_export,
+    latest_message_id,
+    message_writer,
+)
+from http_cache import (
+    GZIP_LEVEL,
+    GZIP_MIN_SIZE,
+    etag_matches,
+    messages_etag,
+    rooms_etag,
+)
+from server import (
+    API_PORT,
+    set_message_store,
+    set_room_access_check,
+    set_room_closed_hook,
+    set_room_loader,
+)
+from hashing import HashPoolSaturated
+import metrics
+import timing
+from tokens import issue_token, revoke_token, verify_token
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Counts JSON encoding towards the request's serialize phase."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        with timing.phase("serialize"):
+            return super().dumps(obj, **kwargs)
+
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 swagger = Swagger(app, template_file="../swagger.yaml")
+set_message_store(message_writer.enqueue)
+set_room_closed_hook(invalidate_room)
+set_room_loader(load_active_room)
+set_room_access_check(has_room_access)
+
+
+@app.errorhandler(HashPoolSaturated)
+def hashing_saturated(e: HashPoolSaturated) -> tuple[Response, Literal[503]]:
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
+metrics.histogram(
+    "http_request_seconds", "API request latency by method, route and status"
+)
+
+
+@app.before_request
+def start_timer() -> None:
+    g.request_started = time.perf_counter()
+    timing.start_request()
+    begin_request_session()
+
+
+@app.after_request
+def record_request_time(response: Response) -> Response:
+    started = g.pop("request_started", None)
+    phases = timing.finish_request()
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        metrics.observe(
+            "http_request_seconds",
+            elapsed,
+            method=request.method,
+            route=request.url_rule.rule if request.url_rule else "unmatched",
+            status=response.status_code,
+        )
+        if timing.SERVER_TIMING and phases is not None:
+            response.headers["Server-Timing"] = timing.server_timing_header(
+                phases, elapsed
+            )
+    return response
+
+
+@app.teardown_request
+def close_request_session(error: BaseException | None) -> None:
+    end_request_session()
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """Gzip buffered 200 responses of at least GZIP_MIN_SIZE bytes."""
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or "gzip" not in request.headers.get("Accept-Encoding", "")
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def not_modified(etag: str) -> tuple[Response, Literal[304]] | None:
+    """A 304 response if the request's If-None-Match already has `etag`."""
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(headers={"ETag": etag}), 304
+    return None
+
+
+def bearer_token() -> str | None:
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return token if scheme.lower() == "bearer" else None
+
+
+def require_session(view: Callable) -> Callable:
+    """Verifies the bearer session token and exposes its claims as `g.session`."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with timing.phase("auth"):
+            session = verify_token(bearer_token())
+        if session is None:
+            return jsonify({"error": "Invalid or expired session"}), 401
+        g.session = session
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def check_room_access(
+    room_id: int,
+) -> tuple[Response, Literal[404]] | tuple[Response, Literal[403]] | None:
+    """An error response unless the room exists and the session user may read
+    it; private rooms need a grant from /rooms/join."""
+    if not get_room(room_id):
+        return jsonify({"error": "Room not found"}), 404
+    if not has_room_access(g.session.user_id, room_id):
+        return jsonify({"error": "Join this private room first"}), 403
+    return None
 
 
 @app.route("/")
@@ -18,6 +173,11 @@ def index() -> Response:
     return jsonify({"message": "Hello, World!"})
 
 
+@app.route("/metrics")
+def metrics_endpoint() -> Response:
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/register", methods=["POST"])
 def register() -> tuple[Response, Literal[201]] | tuple[Response, Literal[400]]:
     data = request.get_json()
@@ -30,6 +190,7 @@ def register() -> tuple[Response, Literal[201]] | tuple[Response, Literal[400]]:
                 {
                     "message": f"User '{username}' registered successfully!",
                     "id": user.id,
+                    "token": issue_token(user.id, user.username),
                 }
             ),
             201,
@@ -45,16 +206,33 @@ def login() -> tuple[Response, Literal[200]] | tuple[Response, Literal[401]]:
     password = data.get("password")
     user = authenticate_user(username, password)
     if user:
-        return jsonify({"message": "Login successful", "id": user.id}), 200
+        return (
+            jsonify(
+                {
+                    "message": "Login successful",
+                    "id": user.id,
+                    "token": issue_token(user.id, user.username),
+                }
+            ),
+            200,
+        )
     else:
         return jsonify({"error": "Invalid credentials"}), 401
 
 
+@app.route("/logout", methods=["POST"])
+@require_session
+def logout() -> tuple[Response, Literal[200]]:
+    revoke_token(bearer_token())
+    return jsonify({"message": "Logged out"}), 200
+
+
 @app.route("/rooms", methods=["POST"])
+@require_session
 def create_chat_room() -> tuple[Response, Literal[201]] | tuple[Response, Literal[400]]:
     data = request.get_json()
     name = data.get("name")
-    admin_id = data.get("admin_id")
+    admin_id = g.session.user_id
     timeout_minutes = data.get("timeout_minutes")
     is_private = data.get("is_private", False)
     access_code = data.get("access_code", None)
@@ -70,8 +248,8 @@ def create_chat_room() -> tuple[Response, Literal[201]] | tuple[Response, Litera
         return (
             jsonify(
                 {
-                    "message": f"Room '{room.name}' created successfully",
-                    "room_id": room.id,
+                    "message": f"Room '{room['name']}' created successfully",
+                    "room_id": room["id"],
                 }
             ),
             201,
@@ -81,9 +259,10 @@ def create_chat_room() -> tuple[Response, Literal[201]] | tuple[Response, Litera
 
 
 @app.route("/rooms/join", methods=["POST"])
+@require_session
 def join_chat_room() -> tuple[Response, Literal[200]] | tuple[Response, Literal[400]]:
     data = request.get_json()
-    user_id = data.get("user_id")
+    user_id = g.session.user_id
     room_id = data.get("room_id")
     access_code = data.get("access_code", None)
 
@@ -97,12 +276,23 @@ def join_chat_room() -> tuple[Response, Literal[200]] | tuple[Response, Literal[
 
 
 @app.route("/rooms", methods=["GET"])
-def list_public_rooms() -> tuple[Response, Literal[200]]:
-    rooms = get_public_rooms()
+def list_public_rooms() -> (
+    tuple[Response, Literal[200]] | tuple[Response, Literal[304]]
+):
+    rooms = get_public_rooms(
+        limit=request.args.get("limit", ROOM_PAGE_SIZE, type=int),
+        after_id=request.args.get("after_id", 0, type=int),
+    )
     room_list = [
-        {"id": room.id, "name": room.name, "admin_id": room.admin_id} for room in rooms
+        {"id": room["id"], "name": room["name"], "admin_id": room["admin_id"]}
+        for room in rooms
     ]
-    return jsonify(room_list), 200
+    etag = rooms_etag(room_list)
+    if cached := not_modified(etag):
+        return cached
+    response = jsonify(room_list)
+    response.headers["ETag"] = etag
+    return response, 200
 
 
 @app.route("/rooms/<int:room_id>", methods=["GET"])
@@ -115,10 +305,10 @@ def get_chat_room(
     return (
         jsonify(
             {
-                "id": room.id,
-                "name": room.name,
-                "admin_id": room.admin_id,
-                "port": room.port,
+                "id": room["id"],
+                "name": room["name"],
+                "admin_id": room["admin_id"],
+                "port": room["port"],
             }
         ),
         200,
@@ -126,24 +316,17 @@ def get_chat_room(
 
 
 @app.route("/rooms/<int:room_id>/messages", methods=["POST"])
+@require_session
 def post_message(
     room_id: int,
-) -> (
-    tuple[Response, Literal[404]]
-    | tuple[Response, Literal[201]]
-    | tuple[Response, Literal[400]]
-):
+) -> tuple[Response, Literal[201]] | tuple[Response, Literal[400]]:
+    if denied := check_room_access(room_id):
+        return denied
     data = request.get_json()
-    user_id = data.get("user_id")
     content = data.get("content")
 
-    with SessionLocal() as session:
-        user = session.query(User).filter(User.id == user_id).first()
-        if not user:
-            return jsonify({"error": "User not found"}), 404
-
     try:
-        message_data = send_message(user, room_id, content)
+        message_data = send_message(g.session.user_id, room_id, content)
         return (
             jsonify({"message": "Message sent", "content": message_data["content"]}),
             201,
@@ -153,18 +336,51 @@ def post_message(
 
 
 @app.route("/rooms/<int:room_id>/messages", methods=["GET"])
-def get_messages(room_id: int) -> tuple[Response, Literal[200]]:
-    messages = get_room_messages(room_id)
+@require_session
+def get_messages(
+    room_id: int,
+) -> tuple[Response, Literal[200]] | tuple[Response, Literal[304]]:
+    if denied := check_room_access(room_id):
+        return denied
+    limit = request.args.get("limit", MESSAGE_PAGE_SIZE, type=int)
+    before_id = request.args.get("before_id", type=int)
+    after_id = request.args.get("after_id", type=int)
+    etag = messages_etag(
+        room_id, latest_message_id(room_id), limit, before_id, after_id
+    )
+    if cached := not_modified(etag):
+        return cached
+
+    messages = get_room_messages(
+        room_id, limit=limit, before_id=before_id, after_id=after_id
+    )
     message_list = [
         {
+            "id": message.id,
             "username": message.user.username,
             "content": message.content,
             "timestamp": message.timestamp.isoformat(),
         }
         for message in messages
     ]
-    return jsonify(message_list), 200
+    response = jsonify(message_list)
+    response.headers["ETag"] = etag
+    return response, 200
+
+
+@app.route("/rooms/<int:room_id>/messages/export", methods=["GET"])
+@require_session
+def export_messages(room_id: int) -> Response:
+    if denied := check_room_access(room_id):
+        return denied
+    # The export streams on its own session; give back the request's
+    # connection rather than hold it for the whole download.
+    end_request_session()
+    return Response(
+        stream_with_context(iter_room_export(room_id)),
+        mimetype="application/x-ndjson",
+    )
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(debug=True, port=API_PORT)
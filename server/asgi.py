@@ -0,0 +1,361 @@
+"""ASGI version of the HTTP API in app.py, with the same routes and responses.
+
+Reads go through the async engine (database.async_session). Registration,
+login and room/message writes reuse the synchronous functions on Starlette's
+thread pool, since they wait on bcrypt anyway. The room gateway is not started
+here; run gateway.py next to it:
+
+    uv run asgi.py            # or: uvicorn asgi:app --port 5000 --workers 4
+    uv run gateway.py
+"""
+
+from dotenv import load_dotenv
+
+load_dotenv()
+import os
+import time
+from functools import wraps
+from typing import Callable
+
+import uvicorn
+import yaml
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse as BaseJSONResponse
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from auth import authenticate_user, register_user
+from hashing import HashPoolSaturated
+import metrics
+import timing
+from http_cache import (
+    GZIP_LEVEL,
+    GZIP_MIN_SIZE,
+    etag_matches,
+    messages_etag,
+    rooms_etag,
+)
+from message import (
+    MESSAGE_PAGE_SIZE,
+    aiter_room_export,
+    fetch_latest_message_id,
+    fetch_room_messages,
+    send_message,
+)
+from room import (
+    ROOM_PAGE_SIZE,
+    create_room,
+    fetch_public_rooms,
+    fetch_room,
+    fetch_room_access,
+    join_room,
+)
+from server import API_PORT, set_embedded_gateway
+from tokens import issue_token, revoke_token, verify_token
+
+
+class JSONResponse(BaseJSONResponse):
+    """Counts JSON encoding towards the request's serialize phase."""
+
+    def render(self, content) -> bytes:
+        with timing.phase("serialize"):
+            return super().render(content)
+
+
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+SWAGGER_FILE = os.path.join(os.path.dirname(__file__), "..", "swagger.yaml")
+
+set_embedded_gateway(False)
+metrics.histogram(
+    "http_request_seconds", "API request latency by method, route and status"
+)
+
+with open(SWAGGER_FILE) as f:
+    swagger_spec = yaml.safe_load(f)
+
+
+async def record_request_time(request: Request, call_next) -> Response:
+    started = time.perf_counter()
+    timing.start_request()
+    response = await call_next(request)
+    phases = timing.finish_request()
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    metrics.observe(
+        "http_request_seconds",
+        elapsed,
+        method=request.method,
+        route=route.path if route else "unmatched",
+        status=response.status_code,
+    )
+    if timing.SERVER_TIMING and phases is not None:
+        response.headers["Server-Timing"] = timing.server_timing_header(phases, elapsed)
+    return response
+
+
+async def hashing_saturated(request: Request, e: HashPoolSaturated) -> JSONResponse:
+    return JSONResponse({"error": str(e)}, 503, headers={"Retry-After": "1"})
+
+
+def bearer_token(request: Request) -> str | None:
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return token if scheme.lower() == "bearer" else None
+
+
+def require_session(view: Callable) -> Callable:
+    """Verifies the bearer session token and exposes its claims as
+    `request.state.session`."""
+
+    @wraps(view)
+    async def wrapper(request: Request) -> JSONResponse:
+        with timing.phase("auth"):
+            session = verify_token(bearer_token(request))
+        if session is None:
+            return JSONResponse({"error": "Invalid or expired session"}, 401)
+        request.state.session = session
+        return await view(request)
+
+    return wrapper
+
+
+async def check_room_access(request: Request, room_id: int) -> JSONResponse | None:
+    """An error response unless the room exists and the session user may read
+    it; private rooms need a grant from /rooms/join."""
+    if not await fetch_room(room_id):
+        return JSONResponse({"error": "Room not found"}, 404)
+    if not await fetch_room_access(request.state.session.user_id, room_id):
+        return JSONResponse({"error": "Join this private room first"}, 403)
+    return None
+
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    """A 304 response if the request's If-None-Match already has `etag`."""
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def int_arg(request: Request, name: str, default: int | None = None) -> int | None:
+    """Like Flask's `request.args.get(name, default, type=int)`."""
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+async def index(request: Request) -> JSONResponse:
+    return JSONResponse({"message": "Hello, World!"})
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+async def apispec(request: Request) -> JSONResponse:
+    return JSONResponse(swagger_spec)
+
+
+async def register(request: Request) -> JSONResponse:
+    data = await request.json()
+    username = data.get("username")
+    password = data.get("password")
+    try:
+        user = await run_in_threadpool(register_user, username, password)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    return JSONResponse(
+        {
+            "message": f"User '{username}' registered successfully!",
+            "id": user.id,
+            "token": issue_token(user.id, user.username),
+        },
+        201,
+    )
+
+
+async def login(request: Request) -> JSONResponse:
+    data = await request.json()
+    user = await run_in_threadpool(
+        authenticate_user, data.get("username"), data.get("password")
+    )
+    if not user:
+        return JSONResponse({"error": "Invalid credentials"}, 401)
+    return JSONResponse(
+        {
+            "message": "Login successful",
+            "id": user.id,
+            "token": issue_token(user.id, user.username),
+        },
+        200,
+    )
+
+
+@require_session
+async def logout(request: Request) -> JSONResponse:
+    revoke_token(bearer_token(request))
+    return JSONResponse({"message": "Logged out"}, 200)
+
+
+@require_session
+async def create_chat_room(request: Request) -> JSONResponse:
+    data = await request.json()
+    try:
+        room = await run_in_threadpool(
+            create_room,
+            admin_id=request.state.session.user_id,
+            name=data.get("name"),
+            timeout_minutes=data.get("timeout_minutes"),
+            is_private=data.get("is_private", False),
+            access_code=data.get("access_code", None),
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    return JSONResponse(
+        {
+            "message": f"Room '{room['name']}' created successfully",
+            "room_id": room["id"],
+        },
+        201,
+    )
+
+
+@require_session
+async def join_chat_room(request: Request) -> JSONResponse:
+    data = await request.json()
+    room_id = data.get("room_id")
+    try:
+        room = await run_in_threadpool(
+            join_room,
+            request.state.session.user_id,
+            room_id,
+            data.get("access_code", None),
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    if not room:
+        return JSONResponse({"error": "Failed to join room"}, 400)
+    return JSONResponse({"message": f"Joined room with ID {room_id}"}, 200)
+
+
+async def list_public_rooms(request: Request) -> Response:
+    rooms = await fetch_public_rooms(
+        limit=int_arg(request, "limit", ROOM_PAGE_SIZE),
+        after_id=int_arg(request, "after_id", 0),
+    )
+    room_list = [
+        {"id": room["id"], "name": room["name"], "admin_id": room["admin_id"]}
+        for room in rooms
+    ]
+    etag = rooms_etag(room_list)
+    if cached := not_modified(request, etag):
+        return cached
+    return JSONResponse(room_list, 200, headers={"ETag": etag})
+
+
+async def get_chat_room(request: Request) -> JSONResponse:
+    room = await fetch_room(request.path_params["room_id"])
+    if not room:
+        return JSONResponse({"error": "Room not found"}, 404)
+    return JSONResponse(
+        {
+            "id": room["id"],
+            "name": room["name"],
+            "admin_id": room["admin_id"],
+            "port": room["port"],
+        },
+        200,
+    )
+
+
+@require_session
+async def post_message(request: Request) -> JSONResponse:
+    if denied := await check_room_access(request, request.path_params["room_id"]):
+        return denied
+    data = await request.json()
+    try:
+        message_data = await run_in_threadpool(
+            send_message,
+            request.state.session.user_id,
+            request.path_params["room_id"],
+            data.get("content"),
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    return JSONResponse(
+        {"message": "Message sent", "content": message_data["content"]}, 201
+    )
+
+
+@require_session
+async def get_messages(request: Request) -> Response:
+    room_id = request.path_params["room_id"]
+    if denied := await check_room_access(request, room_id):
+        return denied
+    limit = int_arg(request, "limit", MESSAGE_PAGE_SIZE)
+    before_id = int_arg(request, "before_id")
+    after_id = int_arg(request, "after_id")
+    etag = messages_etag(
+        room_id, await fetch_latest_message_id(room_id), limit, before_id, after_id
+    )
+    if cached := not_modified(request, etag):
+        return cached
+
+    messages = await fetch_room_messages(
+        room_id, limit=limit, before_id=before_id, after_id=after_id
+    )
+    message_list = [
+        {
+            "id": message.id,
+            "username": message.user.username,
+            "content": message.content,
+            "timestamp": message.timestamp.isoformat(),
+        }
+        for message in messages
+    ]
+    return JSONResponse(message_list, 200, headers={"ETag": etag})
+
+
+@require_session
+async def export_messages(request: Request) -> Response:
+    room_id = request.path_params["room_id"]
+    if denied := await check_room_access(request, room_id):
+        return denied
+    return StreamingResponse(
+        aiter_room_export(room_id),
+        media_type="application/x-ndjson",
+    )
+
+
+app = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/apispec_1.json", apispec),
+        Route("/metrics", metrics_endpoint),
+        Route("/register", register, methods=["POST"]),
+        Route("/login", login, methods=["POST"]),
+        Route("/logout", logout, methods=["POST"]),
+        Route("/rooms", list_public_rooms, methods=["GET"]),
+        Route("/rooms", create_chat_room, methods=["POST"]),
+        Route("/rooms/join", join_chat_room, methods=["POST"]),
+        Route("/rooms/{room_id:int}", get_chat_room),
+        Route("/rooms/{room_id:int}/messages", get_messages, methods=["GET"]),
+        Route("/rooms/{room_id:int}/messages", post_message, methods=["POST"]),
+        Route("/rooms/{room_id:int}/messages/export", export_messages),
+    ],
+    exception_handlers={HashPoolSaturated: hashing_saturated},
+    middleware=[
+        Middleware(BaseHTTPMiddleware, dispatch=record_request_time),
+        Middleware(
+            GZipMiddleware, minimum_size=GZIP_MIN_SIZE, compresslevel=GZIP_LEVEL
+        ),
+    ],
+)
+
+
+if __name__ == "__main__":
+    uvicorn.run("asgi:app", port=API_PORT, workers=API_WORKERS)
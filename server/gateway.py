@@ -0,0 +1,26 @@
+"""Runs the room gateway on its own, for when the HTTP API is served by several
+worker processes (see asgi.py) and so cannot host it in-process.
+
+    uv run gateway.py
+"""
+
+from dotenv import load_dotenv
+
+load_dotenv()
+from message import message_writer
+from room import has_room_access, invalidate_room, load_active_room
+from server import (
+    GATEWAY_PORT,
+    run_room_gateway,
+    set_message_store,
+    set_room_access_check,
+    set_room_closed_hook,
+    set_room_loader,
+)
+
+if __name__ == "__main__":
+    set_message_store(message_writer.enqueue)
+    set_room_closed_hook(invalidate_room)
+    set_room_loader(load_active_room)
+    set_room_access_check(has_room_access)
+    run_room_gateway(GATEWAY_PORT)
@@ -0,0 +1,147 @@
+"""bcrypt hashing and verification on a dedicated process pool.
+
+Request threads hand the work to the pool and wait for it. At most
+HASH_WORKERS + HASH_QUEUE_SIZE calls can be admitted at once. Further calls
+fail fast with HashPoolSaturated, and the API answers those with 503. If a
+worker dies the pool is rebuilt and the call retried once.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+import metrics
+import timing
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", "64"))
+
+
+class HashPoolSaturated(Exception):
+    pass
+
+
+# Workers are never forked from the API process, which runs request, gateway and
+# writer threads; forkserver (spawn where unavailable) starts them clean.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _mp_context = multiprocessing.get_context("forkserver")
+    _mp_context.set_forkserver_preload(["hashing"])
+else:
+    _mp_context = multiprocessing.get_context("spawn")
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+_stats_lock = threading.Lock()
+_stats = {
+    "calls": 0,
+    "rejected": 0,
+    "queue_wait_seconds": 0.0,
+    "hash_seconds": 0.0,
+    "max_queue_wait_seconds": 0.0,
+}
+
+
+metrics.histogram("bcrypt_seconds", "Time spent in bcrypt by operation")
+metrics.histogram("bcrypt_queue_wait_seconds", "Time bcrypt calls waited for a worker")
+metrics.counter("bcrypt_rejected_total", "bcrypt calls refused while saturated")
+metrics.counter("bcrypt_pool_restarts_total", "Process pools replaced after breaking")
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=HASH_WORKERS, mp_context=_mp_context
+            )
+        return _executor
+
+
+def _replace_executor(broken: ProcessPoolExecutor) -> None:
+    """Drop `broken` so the next call starts a new pool, unless another
+    thread already replaced it."""
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+            broken.shutdown(wait=False, cancel_futures=True)
+            metrics.inc("bcrypt_pool_restarts_total")
+            print("bcrypt process pool broke; starting a new one.")
+
+
+def _submit(function, *args) -> tuple[object, float, float]:
+    for _ in range(2):
+        executor = _get_executor()
+        try:
+            return executor.submit(_timed, function, *args).result()
+        except BrokenProcessPool:
+            _replace_executor(executor)
+    raise HashPoolSaturated("Password hashing is unavailable, try again shortly.")
+
+
+def _timed(function, *args) -> tuple[object, float, float]:
+    started = time.time()
+    result = function(*args)
+    return result, started, time.time() - started
+
+
+def _hashpw(secret: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(secret, bcrypt.gensalt(rounds))
+
+
+def _checkpw(secret: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(secret, hashed)
+
+
+def _run(function, *args):
+    if not _slots.acquire(blocking=False):
+        with _stats_lock:
+            _stats["rejected"] += 1
+        metrics.inc("bcrypt_rejected_total")
+        raise HashPoolSaturated("Password hashing is saturated, try again shortly.")
+    try:
+        submitted = time.time()
+        result, started, seconds = _submit(function, *args)
+    finally:
+        _slots.release()
+    timing.add("auth", time.time() - submitted)
+    queue_wait = max(started - submitted, 0.0)
+    operation = function.__name__.lstrip("_")
+    metrics.observe("bcrypt_seconds", seconds, operation=operation)
+    metrics.observe("bcrypt_queue_wait_seconds", queue_wait)
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats["queue_wait_seconds"] += queue_wait
+        _stats["hash_seconds"] += seconds
+        _stats["max_queue_wait_seconds"] = max(
+            _stats["max_queue_wait_seconds"], queue_wait
+        )
+    return result
+
+
+def hashpw(secret: bytes, rounds: int = BCRYPT_ROUNDS) -> bytes:
+    return _run(_hashpw, secret, rounds)
+
+
+def checkpw(secret: bytes, hashed: bytes) -> bool:
+    return _run(_checkpw, secret, hashed)
+
+
+def hash_stats() -> dict:
+    with _stats_lock:
+        return {
+            **_stats,
+            "workers": HASH_WORKERS,
+            "queue_size": HASH_QUEUE_SIZE,
+            "rounds": BCRYPT_ROUNDS,
+        }
+
+
+metrics.stats_gauges("bcrypt_pool", "bcrypt process pool", hash_stats)
@@ -0,0 +1,43 @@
+"""Validators for conditional GETs and the response compression threshold.
+
+Both validators are derived from data every API process can see, so any
+worker may answer a revalidation from another worker's response.
+"""
+
+import hashlib
+import os
+
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of `etag` against an If-None-Match header."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == wanted for tag in if_none_match.split(",")
+    )
+
+
+def rooms_etag(rooms: list[dict]) -> str:
+    """Digest of a room-list page; the page is at most MAX_ROOM_PAGE_SIZE rows."""
+    digest = hashlib.blake2b(digest_size=12)
+    for room in rooms:
+        digest.update(f"{room['id']}\0{room['name']}\0{room['admin_id']}\n".encode())
+    return f'W/"rooms-{digest.hexdigest()}"'
+
+
+def messages_etag(
+    room_id: int,
+    latest_id: int,
+    limit: int | None,
+    before_id: int | None,
+    after_id: int | None,
+) -> str:
+    """Messages are never edited, so a page can only change when a newer
+    message is stored in its room."""
+    return f'W/"messages-{room_id}-{latest_id}-{limit}-{before_id}-{after_id}"'
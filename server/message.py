@@ -1,50 +1,521 @@
+from collections import OrderedDict
 from typing import List
+from sqlalchemy import func, insert, select
+from sqlalchemy.sql import Select
 from sqlalchemy.orm import Session, joinedload
 from datetime import datetime
-from database import Message, User, Room, SessionLocal
+from database import Message, SessionLocal, User, async_session, db_session
+from room import get_room
+import metrics
+import timing
+import atexit
 import os
+import queue
+import struct
+import sys
+import threading
+import time
+from base64 import urlsafe_b64decode
+from typing import AsyncIterator, Iterator
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
 if ENCRYPTION_KEY is None:
     raise ValueError("ENCRYPTION_KEY is not set in environment variables.")
 
 
+# Legacy format: Fernet tokens stored as text in Message.content.
 cipher = Fernet(ENCRYPTION_KEY.encode())
 
+# Current format: AES-256-GCM envelopes stored as raw bytes in Message.ciphertext,
+#   version u8 | key id u16 | nonce (12 bytes) | ciphertext + tag (16 bytes)
+# with the version/key id header authenticated as associated data.
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct("!BH")
+NONCE_SIZE = 12
 
-def encrypt_message(content: str) -> str:
-    return cipher.encrypt(content.encode()).decode()
 
+def load_message_keys() -> dict[int, AESGCM]:
+    """Reads MESSAGE_KEYS ("id:urlsafe-base64 key,..."), or derives key 1 from
+    ENCRYPTION_KEY so existing deployments need no new settings."""
+    configured = os.getenv("MESSAGE_KEYS")
+    if not configured:
+        key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b"chat-message-envelope-v1",
+        ).derive(urlsafe_b64decode(ENCRYPTION_KEY))
+        return {1: AESGCM(key)}
+    keys = {}
+    for entry in configured.split(","):
+        key_id, _, key = entry.strip().partition(":")
+        keys[int(key_id)] = AESGCM(urlsafe_b64decode(key))
+    return keys
 
-def decrypt_message(encrypted_content: str) -> str:
-    return cipher.decrypt(encrypted_content.encode()).decode()
 
+message_keys = load_message_keys()
+MESSAGE_KEY_ID = int(os.getenv("MESSAGE_KEY_ID", max(message_keys)))
+if MESSAGE_KEY_ID not in message_keys:
+    raise ValueError(f"MESSAGE_KEY_ID {MESSAGE_KEY_ID} is not in MESSAGE_KEYS.")
+
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 500
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.25"))
+MESSAGE_QUEUE_DEPTH = int(os.getenv("MESSAGE_QUEUE_DEPTH", "10000"))
+# A failed batch is retried after MESSAGE_RETRY_BACKOFF seconds, doubling each
+# time; with the defaults a batch survives a database outage of about 15s.
+MESSAGE_WRITE_RETRIES = int(os.getenv("MESSAGE_WRITE_RETRIES", "5"))
+MESSAGE_RETRY_BACKOFF = float(os.getenv("MESSAGE_RETRY_BACKOFF", "0.5"))
+MESSAGE_CACHE_BYTES = int(os.getenv("MESSAGE_CACHE_BYTES", str(32 << 20)))
+# Bytes a cache entry costs besides its string: the int key and the dict and
+# OrderedDict nodes (measured with tracemalloc on CPython 3.11).
+MESSAGE_CACHE_ENTRY_OVERHEAD = 136
+REENCRYPT_BATCH_SIZE = 500
+MESSAGE_EXPORT_BATCH_SIZE = int(os.getenv("MESSAGE_EXPORT_BATCH_SIZE", "1000"))
+
+try:
+    import orjson
+
+    def dumps_line(record: dict) -> bytes:
+        return orjson.dumps(record) + b"\n"
+
+except ImportError:
+    import json
+
+    def dumps_line(record: dict) -> bytes:
+        return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+metrics.histogram(
+    "message_crypto_seconds",
+    "Time to encrypt or decrypt one message",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005),
+)
+
+
+def encrypt_message(content: str, key_id: int = MESSAGE_KEY_ID) -> bytes:
+    started = time.perf_counter()
+    header = ENVELOPE_HEADER.pack(ENVELOPE_VERSION, key_id)
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = message_keys[key_id].encrypt(nonce, content.encode(), header)
+    envelope = b"".join((header, nonce, sealed))
+    elapsed = time.perf_counter() - started
+    metrics.observe("message_crypto_seconds", elapsed, operation="encrypt")
+    timing.add("crypto", elapsed)
+    return envelope
+
+
+def envelope_key_id(envelope: bytes) -> int:
+    version, key_id = ENVELOPE_HEADER.unpack_from(envelope)
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported message envelope version {version}.")
+    return key_id
+
+
+def decrypt_message(encrypted_content: bytes | str) -> str:
+    """Decrypts an envelope, or a legacy Fernet token given as text."""
+    started = time.perf_counter()
+    if isinstance(encrypted_content, str):
+        content = cipher.decrypt(encrypted_content.encode()).decode()
+        operation = "decrypt_legacy"
+    else:
+        envelope = bytes(encrypted_content)
+        key_id = envelope_key_id(envelope)
+        header_end = ENVELOPE_HEADER.size
+        nonce = envelope[header_end : header_end + NONCE_SIZE]
+        sealed = envelope[header_end + NONCE_SIZE :]
+        content = (
+            message_keys[key_id].decrypt(nonce, sealed, envelope[:header_end]).decode()
+        )
+        operation = "decrypt"
+    elapsed = time.perf_counter() - started
+    metrics.observe("message_crypto_seconds", elapsed, operation=operation)
+    timing.add("crypto", elapsed)
+    return content
+
+
+def stored_ciphertext(message) -> bytes | str:
+    return message.ciphertext if message.ciphertext is not None else message.content
 
-def send_message(user: User, room_id: int, content: str) -> Message:
-    encrypted_content = encrypt_message(content)
-    with SessionLocal() as session:
-        room = session.query(Room).filter_by(id=room_id).first()
-        if not room:
-            raise ValueError("Room not found.")
 
-        message = Message(content=encrypted_content, room_id=room.id, user_id=user.id)
+def entry_size(content: str) -> int:
+    return sys.getsizeof(content) + MESSAGE_CACHE_ENTRY_OVERHEAD
+
+
+class DecryptedMessageCache:
+    """LRU of decrypted message bodies keyed by message id, capped by memory.
+
+    Stored messages never change, so an entry stays valid until it is evicted.
+    """
+
+    def __init__(self, max_bytes: int = MESSAGE_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[int, str] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, message_id: int) -> str | None:
+        with self._lock:
+            content = self._entries.get(message_id)
+            if content is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(message_id)
+            self.hits += 1
+            return content
+
+    def put(self, message_id: int, content: str) -> None:
+        size = entry_size(content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(message_id, None)
+            if previous is not None:
+                self._size -= entry_size(previous)
+            self._entries[message_id] = content
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= entry_size(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+message_cache = DecryptedMessageCache()
+metrics.stats_gauges("message_cache", "Decrypted message cache", message_cache.stats)
+
+
+def send_message(user_id: int, room_id: int, content: str) -> dict:
+    if not get_room(room_id):
+        raise ValueError("Room not found.")
+
+    encrypted_content = encrypt_message(content)
+    with db_session() as session:
+        message = Message(
+            ciphertext=encrypted_content, room_id=room_id, user_id=user_id
+        )
         session.add(message)
         session.commit()
+        message_cache.put(message.id, content)
 
-        decrypted_content = decrypt_message(message.content)
+        return {"content": content, "user_id": user_id, "room_id": room_id}
 
-        return {"content": decrypted_content, "user_id": user.id, "room_id": room.id}
 
-
-def get_room_messages(room_id: int) -> List[Message]:
-    with SessionLocal() as session:
-        messages = (
-            session.query(Message)
-            .filter_by(room_id=room_id)
-            .options(joinedload(Message.user))
-            .all()
+def room_messages_query(
+    room_id: int, limit: int, before_id: int | None, after_id: int | None
+) -> Select:
+    """Newest-first unless `after_id` is given; see get_room_messages."""
+    query = (
+        select(Message)
+        .where(Message.room_id == room_id)
+        .options(joinedload(Message.user))
+    )
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    if after_id is not None:
+        return (
+            query.where(Message.id > after_id).order_by(Message.id.asc()).limit(limit)
         )
+    return query.order_by(Message.id.desc()).limit(limit)
+
+
+def decrypt_page(messages: List[Message], newest_first: bool) -> List[Message]:
+    """Fill in each message's plaintext content, in ascending id order."""
+    if newest_first:
+        messages.reverse()
+    for message in messages:
+        content = message_cache.get(message.id)
+        if content is None:
+            content = decrypt_message(stored_ciphertext(message))
+            message_cache.put(message.id, content)
+        message.content = content
+    return messages
+
+
+def get_room_messages(
+    room_id: int,
+    limit: int = MESSAGE_PAGE_SIZE,
+    before_id: int | None = None,
+    after_id: int | None = None,
+) -> List[Message]:
+    """Returns one page of a room's messages in ascending id order.
+
+    With `after_id` the page starts right after that message; otherwise it is the
+    newest `limit` messages, older than `before_id` when given.
+    """
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    query = room_messages_query(room_id, limit, before_id, after_id)
+    with db_session() as session:
+        messages = list(session.scalars(query))
+        # Detached, so the plaintext set by decrypt_page is never flushed by a
+        # later commit on the request's shared session.
         for message in messages:
-            message.content = decrypt_message(message.content)
-        return messages
+            session.expunge(message)
+        return decrypt_page(messages, newest_first=after_id is None)
+
+
+async def fetch_room_messages(
+    room_id: int,
+    limit: int = MESSAGE_PAGE_SIZE,
+    before_id: int | None = None,
+    after_id: int | None = None,
+) -> List[Message]:
+    """get_room_messages on the async engine."""
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    query = room_messages_query(room_id, limit, before_id, after_id)
+    async with async_session() as session:
+        messages = list(await session.scalars(query))
+        return decrypt_page(messages, newest_first=after_id is None)
+
+
+def latest_message_id(room_id: int) -> int:
+    """Id of the newest stored message in a room (0 if none); one index lookup."""
+    with db_session() as session:
+        return session.scalar(latest_message_id_query(room_id)) or 0
+
+
+async def fetch_latest_message_id(room_id: int) -> int:
+    """latest_message_id on the async engine."""
+    async with async_session() as session:
+        return await session.scalar(latest_message_id_query(room_id)) or 0
+
+
+def latest_message_id_query(room_id: int) -> Select:
+    return select(func.max(Message.id)).where(Message.room_id == room_id)
+
+
+def room_export_query(room_id: int) -> Select:
+    # Plain columns rather than ORM objects, so rows can be dropped as soon as
+    # they have been written out.
+    return (
+        select(
+            Message.id,
+            User.username,
+            Message.content,
+            Message.ciphertext,
+            Message.timestamp,
+        )
+        .join(User, Message.user_id == User.id)
+        .where(Message.room_id == room_id)
+        .order_by(Message.id.asc())
+        .execution_options(stream_results=True, yield_per=MESSAGE_EXPORT_BATCH_SIZE)
+    )
+
+
+def export_line(row) -> bytes:
+    # Looks in the cache but does not fill it: an export would evict every
+    # recently read message.
+    content = message_cache.get(row.id)
+    if content is None:
+        content = decrypt_message(stored_ciphertext(row))
+    return dumps_line(
+        {
+            "id": row.id,
+            "username": row.username,
+            "content": content,
+            "timestamp": row.timestamp.isoformat(),
+        }
+    )
+
+
+def iter_room_export(room_id: int) -> Iterator[bytes]:
+    """A room's whole history as NDJSON lines, oldest first, read through a
+    server-side cursor MESSAGE_EXPORT_BATCH_SIZE rows at a time."""
+    with SessionLocal() as session:
+        for row in session.execute(room_export_query(room_id)):
+            yield export_line(row)
+
+
+async def aiter_room_export(room_id: int) -> AsyncIterator[bytes]:
+    """iter_room_export on the async engine."""
+    async with async_session() as session:
+        result = await session.stream(room_export_query(room_id))
+        async for row in result:
+            yield export_line(row)
+
+
+def reencrypt_messages(
+    after_id: int = 0,
+    batch_size: int = REENCRYPT_BATCH_SIZE,
+    stop: threading.Event | None = None,
+) -> int:
+    """Rewrites legacy Fernet rows and envelopes under retired keys with the
+    current key, one committed chunk at a time, and returns the last id seen.
+
+    Both formats stay readable throughout, so this can run while the server is
+    live; pass the returned id back as `after_id` to resume an interrupted run.
+    """
+    while stop is None or not stop.is_set():
+        with SessionLocal() as session:
+            rows = (
+                session.query(Message.id, Message.content, Message.ciphertext)
+                .filter(Message.id > after_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            updates = [
+                {
+                    "id": row.id,
+                    "content": None,
+                    "ciphertext": encrypt_message(
+                        decrypt_message(stored_ciphertext(row))
+                    ),
+                }
+                for row in rows
+                if row.ciphertext is None
+                or envelope_key_id(row.ciphertext) != MESSAGE_KEY_ID
+            ]
+            if updates:
+                session.bulk_update_mappings(Message, updates)
+                session.commit()
+            after_id = rows[-1].id
+        print(f"Re-encrypted {len(updates)} messages up to id {after_id}.")
+    return after_id
+
+
+class MessageWriter:
+    """Write-behind persistence for messages relayed by the room gateway.
+
+    `enqueue` never blocks; a background thread encrypts queued messages and
+    inserts them with one transaction per batch of `batch_size` messages or
+    per `flush_interval` seconds, whichever comes first. A batch that fails to
+    insert is retried with exponential backoff before it is counted as failed;
+    meanwhile new messages keep queueing up to `max_depth`.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+        max_depth: int = MESSAGE_QUEUE_DEPTH,
+        max_retries: int = MESSAGE_WRITE_RETRIES,
+        retry_backoff: float = MESSAGE_RETRY_BACKOFF,
+    ) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_depth = max_depth
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.last_batch_seconds = 0.0
+        self._queue: queue.Queue[dict] = queue.Queue(maxsize=max_depth)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+
+    def enqueue(self, user_id: int, room_id: int, content: str) -> bool:
+        """Queue a message for persistence; False if the queue is full."""
+        self.start()
+        row = {
+            "content": content,
+            "user_id": user_id,
+            "room_id": room_id,
+            "timestamp": datetime.utcnow(),
+        }
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def write_batch(self, batch: list[dict]) -> None:
+        started = time.perf_counter()
+        for row in batch:
+            row["ciphertext"] = encrypt_message(row.pop("content"))
+        for attempt in range(self.max_retries + 1):
+            try:
+                with SessionLocal() as session:
+                    session.execute(insert(Message), batch)
+                    session.commit()
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.failed += len(batch)
+                    print(f"Failed to persist {len(batch)} messages: {e}")
+                    return
+                delay = self.retry_backoff * 2**attempt
+                self.retried += 1
+                print(
+                    f"Failed to persist {len(batch)} messages, "
+                    f"retrying in {delay:.1f}s: {e}"
+                )
+                time.sleep(delay)
+        self.written += len(batch)
+        self.batches += 1
+        self.last_batch_seconds = time.perf_counter() - started
+
+    def flush(self) -> None:
+        """Block until every message queued so far has been written."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+            "retried": self.retried,
+            "batches": self.batches,
+            "last_batch_seconds": self.last_batch_seconds,
+        }
+
+
+message_writer = MessageWriter()
+metrics.stats_gauges(
+    "message_writer", "Message write-behind queue", message_writer.stats
+)
+atexit.register(message_writer.flush)
@@ -0,0 +1,176 @@
+"""Process-wide metrics, rendered in the Prometheus text format.
+
+Counters and histograms are recorded into cells owned by the calling thread,
+so recording takes no lock and never contends with other threads; a scrape
+sums the cells of all threads. When a thread exits its cells are folded into
+a shared total. Gauges are read from callbacks at scrape time.
+"""
+
+import itertools
+import threading
+import weakref
+from bisect import bisect_left
+from typing import Callable
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = tuple[tuple[str, str], ...]
+GaugeValue = float | dict[Labels, float]
+
+# name -> (type, help, histogram buckets or gauge callback)
+_definitions: dict[str, tuple[str, str, object]] = {}
+_local = threading.local()
+_lock = threading.Lock()
+_live: dict[int, dict] = {}
+_thread_keys = itertools.count()
+_retired: dict = {}
+
+
+class _ThreadExit:
+    """Lives in a thread's local storage; collected when the thread ends."""
+
+
+def counter(name: str, help: str) -> None:
+    _definitions[name] = ("counter", help, None)
+
+
+def histogram(name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> None:
+    _definitions[name] = ("histogram", help, buckets)
+
+
+def gauge(name: str, help: str, read: Callable[[], GaugeValue]) -> None:
+    """Register a gauge; `read` returns a value or a {labels: value} dict."""
+    _definitions[name] = ("gauge", help, read)
+
+
+def stats_gauges(prefix: str, help: str, read: Callable[[], dict]) -> None:
+    """Expose every numeric field of a stats dict as a gauge `<prefix>_<field>`."""
+    for field, value in read().items():
+        if isinstance(value, (int, float)):
+            gauge(f"{prefix}_{field}", f"{help}: {field}", lambda f=field: read()[f])
+
+
+def labels(**values: object) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in values.items()))
+
+
+def _cells() -> dict:
+    cells = getattr(_local, "cells", None)
+    if cells is None:
+        cells = _local.cells = {}
+        key = next(_thread_keys)
+        with _lock:
+            _live[key] = cells
+        _local.exit = _ThreadExit()
+        weakref.finalize(_local.exit, _retire, key)
+    return cells
+
+
+def _retire(key: int) -> None:
+    with _lock:
+        cells = _live.pop(key, None)
+        if cells:
+            _merge(_retired, cells)
+
+
+def _merge(into: dict, cells: dict) -> None:
+    for key, value in list(cells.items()):
+        if isinstance(value, list):
+            total = into.setdefault(key, [0] * len(value))
+            for i, count in enumerate(value):
+                total[i] += count
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def inc(name: str, value: float = 1, **label_values: object) -> None:
+    cells = _cells()
+    key = (name, labels(**label_values))
+    cells[key] = cells.get(key, 0) + value
+
+
+def observe(name: str, value: float, **label_values: object) -> None:
+    buckets = _definitions[name][2]
+    cells = _cells()
+    key = (name, labels(**label_values))
+    # One count per bucket plus +Inf, then the sum and the count.
+    cell = cells.get(key)
+    if cell is None:
+        cell = cells[key] = [0] * (len(buckets) + 3)
+    cell[bisect_left(buckets, value)] += 1
+    cell[-2] += value
+    cell[-1] += 1
+
+
+def value(name: str, **label_values: object) -> float:
+    """Current total of one counter series, summed over all threads."""
+    key = (name, labels(**label_values))
+    with _lock:
+        total = _retired.get(key, 0)
+        for cells in list(_live.values()):
+            total += cells.get(key, 0)
+    return total
+
+
+def _format_labels(pairs: Labels) -> str:
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    totals: dict = {}
+    with _lock:
+        _merge(totals, _retired)
+        for cells in list(_live.values()):
+            _merge(totals, cells)
+    series: dict[str, list] = {}
+    for (name, pairs), value in totals.items():
+        series.setdefault(name, []).append((pairs, value))
+
+    lines = []
+    for name, (kind, help, extra) in _definitions.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "gauge":
+            try:
+                value = extra()
+            except Exception as e:
+                print(f"Error reading gauge {name}: {e}")
+                continue
+            values = value if isinstance(value, dict) else {(): value}
+            for pairs, number in values.items():
+                lines.append(f"{name}{_format_labels(pairs)} {number}")
+        elif kind == "counter":
+            for pairs, number in sorted(series.get(name, [])):
+                lines.append(f"{name}{_format_labels(pairs)} {number}")
+        else:
+            for pairs, cell in sorted(series.get(name, [])):
+                cumulative = 0
+                for bound, count in zip((*extra, "+Inf"), cell):
+                    cumulative += count
+                    bucket_labels = _format_labels((*pairs, ("le", str(bound))))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(pairs)} {cell[-2]}")
+                lines.append(f"{name}_count{_format_labels(pairs)} {cell[-1]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,131 @@
+"""Bounded per-connection outbound queues for the chat servers.
+
+Broadcasting only enqueues encoded frames; each connection has its own writer
+that drains the queue, so a slow reader only ever backs up its own queue.
+A broadcast frame is encoded once and the same bytes object is shared by every
+recipient's queue. Writers wait one flush tick and then send everything that
+is pending as a single scatter-gather write.
+"""
+
+import os
+import socket
+from collections import deque
+from enum import Enum
+
+import metrics
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop_oldest"  # discard the oldest queued frame
+    DISCONNECT = "disconnect"  # give up on the reader entirely
+    COALESCE = "coalesce"  # merge the backlog into one buffer, up to max_bytes
+
+
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "1024"))
+OUTBOUND_QUEUE_BYTES = int(os.getenv("OUTBOUND_QUEUE_BYTES", str(1 << 20)))
+OUTBOUND_OVERFLOW_POLICY = OverflowPolicy(
+    os.getenv("OUTBOUND_OVERFLOW_POLICY", OverflowPolicy.DROP_OLDEST.value)
+)
+FLUSH_INTERVAL = float(os.getenv("OUTBOUND_FLUSH_INTERVAL", "0.002"))
+MAX_BATCH_SIZE = int(os.getenv("OUTBOUND_MAX_BATCH_SIZE", "64"))
+
+
+# Broadcasts against the writes actually issued to deliver them. Recorded as
+# per-thread counters, so the fan-out path takes no shared lock.
+metrics.counter("chat_fanout_broadcasts_total", "Frames broadcast to a room")
+metrics.counter(
+    "chat_fanout_deliveries_total", "Frames queued for recipients by broadcasts"
+)
+metrics.counter("chat_fanout_writes_total", "Batched socket writes issued")
+
+
+def record_broadcast(recipients: int) -> None:
+    metrics.inc("chat_fanout_broadcasts_total")
+    metrics.inc("chat_fanout_deliveries_total", recipients)
+
+
+def record_write() -> None:
+    metrics.inc("chat_fanout_writes_total")
+
+
+def fanout_stats() -> dict:
+    """Writes saved by batching, computed from the counters at scrape time."""
+    broadcasts = metrics.value("chat_fanout_broadcasts_total")
+    saved = max(
+        metrics.value("chat_fanout_deliveries_total")
+        - metrics.value("chat_fanout_writes_total"),
+        0,
+    )
+    return {
+        "syscalls_saved": saved,
+        "syscalls_saved_per_broadcast": saved / broadcasts if broadcasts else 0.0,
+    }
+
+
+metrics.stats_gauges("chat_fanout", "Broadcast fan-out", fanout_stats)
+
+
+class OutboundQueue:
+    """FIFO of encoded frames for one connection. Not thread-safe by itself."""
+
+    def __init__(
+        self,
+        max_frames: int = OUTBOUND_QUEUE_SIZE,
+        policy: OverflowPolicy = OUTBOUND_OVERFLOW_POLICY,
+        max_bytes: int = OUTBOUND_QUEUE_BYTES,
+    ) -> None:
+        self.max_frames = max_frames
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._frames: deque[bytes] = deque()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def put(self, frame: bytes) -> bool:
+        """Queue a frame; returns False if the connection should be dropped."""
+        if self.policy == OverflowPolicy.DROP_OLDEST:
+            while self._frames and (
+                len(self._frames) >= self.max_frames
+                or self._size + len(frame) > self.max_bytes
+            ):
+                self._size -= len(self._frames.popleft())
+                self.dropped += 1
+        elif len(self._frames) >= self.max_frames:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                return False
+            backlog = b"".join(self._frames)
+            self._frames.clear()
+            self._frames.append(backlog)
+        if self._size + len(frame) > self.max_bytes:
+            return False
+        self._frames.append(frame)
+        self._size += len(frame)
+        return True
+
+    def take(self, max_frames: int = MAX_BATCH_SIZE) -> list[bytes]:
+        """Remove and return up to `max_frames` queued frames, oldest first."""
+        frames = []
+        while self._frames and len(frames) < max_frames:
+            frame = self._frames.popleft()
+            self._size -= len(frame)
+            frames.append(frame)
+        return frames
+
+
+def send_batch(sock: socket.socket, frames: list[bytes]) -> None:
+    """Write `frames` with one sendmsg where the platform has it."""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(frames))
+        return
+    buffers = [memoryview(frame) for frame in frames]
+    first = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:])
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
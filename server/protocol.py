@@ -0,0 +1,102 @@
+"""Length-prefixed binary frames shared by the chat servers and clients.
+
+Every frame starts with a fixed header in network byte order:
+
+    version  u8   PROTOCOL_VERSION
+    type     u8   FrameType
+    room     u32  room id (0 for the global chat)
+    sender   u16  length of the UTF-8 sender name that follows the header
+    payload  u32  length of the payload that follows the sender name
+"""
+
+import struct
+from enum import IntEnum
+from typing import NamedTuple
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBIHI")
+MAX_SENDER_SIZE = 255
+MAX_PAYLOAD_SIZE = 1 << 20
+RECV_BUFFER_SIZE = 1 << 16
+
+
+class FrameType(IntEnum):
+    HELLO = 1  # client -> server handshake, sender is the nickname
+    CHAT = 2  # chat line, sender is filled in by the server on relay
+    NOTICE = 3  # server notification
+    RENAME = 4  # sender changed their name to the payload
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Frame(NamedTuple):
+    type: FrameType
+    room: int
+    sender: str
+    payload: bytes
+
+    @property
+    def text(self) -> str:
+        return self.payload.decode("utf-8")
+
+
+def encode_frame(
+    frame_type: FrameType, room: int = 0, sender: str = "", payload: bytes | str = b""
+) -> bytes:
+    sender_bytes = sender.encode("utf-8")
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if len(sender_bytes) > MAX_SENDER_SIZE:
+        raise ProtocolError("Sender name is too long.")
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError("Payload is too large.")
+    header = HEADER.pack(
+        PROTOCOL_VERSION, frame_type, room, len(sender_bytes), len(payload)
+    )
+    return b"".join((header, sender_bytes, payload))
+
+
+class FrameDecoder:
+    """Incrementally decodes frames from arbitrarily split or coalesced reads."""
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[Frame]:
+        """Buffer `data` and return every frame it completes, in order."""
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        offset = 0
+        end = len(buffer)
+        while end - offset >= HEADER.size:
+            version, frame_type, room, sender_size, payload_size = HEADER.unpack_from(
+                buffer, offset
+            )
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Unsupported protocol version {version}.")
+            if sender_size > MAX_SENDER_SIZE or payload_size > MAX_PAYLOAD_SIZE:
+                raise ProtocolError("Frame exceeds the maximum size.")
+            sender_start = offset + HEADER.size
+            payload_start = sender_start + sender_size
+            frame_end = payload_start + payload_size
+            if frame_end > end:
+                break
+            try:
+                frame_type = FrameType(frame_type)
+            except ValueError:
+                raise ProtocolError(f"Unknown frame type {frame_type}.") from None
+            frames.append(
+                Frame(
+                    frame_type,
+                    room,
+                    buffer[sender_start:payload_start].decode("utf-8"),
+                    bytes(buffer[payload_start:frame_end]),
+                )
+            )
+            offset = frame_end
+        if offset:
+            del buffer[:offset]
+        return frames
@@ -0,0 +1,18 @@
+"""Re-encrypts stored messages under the current MESSAGE_KEY_ID.
+
+Safe to run while the server is up. If interrupted, rerun with the last
+reported id to resume:
+
+    uv run reencrypt.py [after_id]
+"""
+
+from dotenv import load_dotenv
+
+load_dotenv()
+import sys
+from message import reencrypt_messages
+
+if __name__ == "__main__":
+    after_id = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    last_id = reencrypt_messages(after_id)
+    print(f"Re-encryption finished at message id {last_id}.")
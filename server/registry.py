@@ -0,0 +1,89 @@
+"""Connection registry for the chat servers, indexed by connection id.
+
+Every room has its own lock, so joins, leaves and broadcast snapshots in one
+room never wait on another room. The shared table lock is only taken to
+create or delete a room entry, and empty rooms are deleted on the last leave.
+"""
+
+import itertools
+import threading
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class _RoomMembers(Generic[T]):
+    __slots__ = ("lock", "members", "closed")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.members: dict[int, T] = {}
+        self.closed = False
+
+
+class ClientRegistry(Generic[T]):
+    def __init__(self) -> None:
+        self._rooms: dict[int, _RoomMembers[T]] = {}
+        self._index: dict[int, tuple[int, _RoomMembers[T]]] = {}
+        self._ids = itertools.count(1)
+        self._table_lock = threading.Lock()
+
+    def add(self, room_id: int, connection: T) -> int:
+        """Register a connection in a room and return its connection id."""
+        connection_id = next(self._ids)
+        while True:
+            room = self._rooms.get(room_id)
+            if room is None:
+                with self._table_lock:
+                    room = self._rooms.setdefault(room_id, _RoomMembers())
+            with room.lock:
+                closed = room.closed
+                if not closed:
+                    room.members[connection_id] = connection
+            if closed:
+                # A concurrent last leave retired this entry; replace it rather
+                # than spin until remove() deletes it.
+                with self._table_lock:
+                    if self._rooms.get(room_id) is room:
+                        self._rooms[room_id] = _RoomMembers()
+                continue
+            self._index[connection_id] = (room_id, room)
+            return connection_id
+
+    def remove(self, connection_id: int) -> T | None:
+        """Unregister a connection; deletes its room entry if it was the last one."""
+        entry = self._index.pop(connection_id, None)
+        if entry is None:
+            return None
+        room_id, room = entry
+        with room.lock:
+            connection = room.members.pop(connection_id, None)
+            if room.members:
+                return connection
+            room.closed = True
+        with self._table_lock:
+            if self._rooms.get(room_id) is room:
+                del self._rooms[room_id]
+        return connection
+
+    def get(self, connection_id: int) -> T | None:
+        entry = self._index.get(connection_id)
+        if entry is None:
+            return None
+        return entry[1].members.get(connection_id)
+
+    def members(self, room_id: int) -> list[T]:
+        """Snapshot of a room's connections, safe to iterate without locks."""
+        room = self._rooms.get(room_id)
+        if room is None:
+            return []
+        with room.lock:
+            return list(room.members.values())
+
+    def room_sizes(self) -> dict[int, int]:
+        return {
+            room_id: len(room.members) for room_id, room in list(self._rooms.items())
+        }
+
+    def __len__(self) -> int:
+        return len(self._index)
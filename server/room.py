@@ -1,17 +1,117 @@
-import threading
-from database import Room, RoomAccess, User, SessionLocal
+from database import Room, RoomAccess, async_session, db_session
+from datetime import datetime
 from typing import Optional
-import socket
-from server import start_room_server
+from sqlalchemy import select
+from sqlalchemy.sql import Select
+from sqlalchemy.exc import IntegrityError
+from server import GATEWAY_PORT, open_room
+import os
+import threading
+import time
+
+ROOM_GRANT_CACHE_SIZE = 100_000
+ROOM_CACHE_TTL = float(os.getenv("ROOM_CACHE_TTL", "30"))
+ROOM_CACHE_SIZE = 10_000
+ROOM_PAGE_SIZE = 50
+MAX_ROOM_PAGE_SIZE = 500
+
+
+class RoomGrantCache:
+    """(user_id, room_id) pairs known to hold a `can_join` grant, oldest evicted first."""
+
+    def __init__(self, max_size: int = ROOM_GRANT_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._grants: dict[tuple[int, int], None] = {}
+        self._lock = threading.Lock()
 
+    def __contains__(self, key: tuple[int, int]) -> bool:
+        return key in self._grants
 
-def get_next_available_port(start_port=5000) -> int:
-    port = start_port
-    while True:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            if s.connect_ex(("localhost", port)) != 0:
-                return port
-        port += 1
+    def add(self, user_id: int, room_id: int) -> None:
+        with self._lock:
+            self._grants[(user_id, room_id)] = None
+            if len(self._grants) > self.max_size:
+                del self._grants[next(iter(self._grants))]
+
+
+room_grants = RoomGrantCache()
+
+
+class TTLCache:
+    """Values that expire `ttl` seconds after they were stored, oldest evicted
+    first beyond `max_size` entries."""
+
+    def __init__(
+        self, ttl: float = ROOM_CACHE_TTL, max_size: int = ROOM_CACHE_SIZE
+    ) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Every entry lives for the same ttl, so insertion order is expiry order.
+        self._entries: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, value)
+            while self._entries and (
+                len(self._entries) > self.max_size
+                or next(iter(self._entries.values()))[0] <= now
+            ):
+                del self._entries[next(iter(self._entries))]
+
+    def invalidate(self, key=None) -> None:
+        """Drop one key, or every entry when no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+# Plain-dict snapshots of rooms (by id) and of the first public room page (by
+# limit); rows change rarely and nothing here holds an ORM object. Later pages
+# are not cached, so clients cannot fill the cache by walking after_id.
+room_cache = TTLCache()
+public_rooms_cache = TTLCache()
+
+
+def room_to_dict(room: Room) -> dict:
+    # Rows backfill_room_expiry has not reached yet have no expires_at.
+    if room.expires_at is None:
+        room.compute_expiry()
+    return {
+        "id": room.id,
+        "name": room.name,
+        "admin_id": room.admin_id,
+        # Every room is served by the gateway; the stored column may still
+        # hold a per-room port, or an earlier ROOM_GATEWAY_PORT.
+        "port": GATEWAY_PORT,
+        "is_private": room.is_private,
+        "expires_at": room.expires_at,
+    }
+
+
+def invalidate_room(room_id: int) -> None:
+    """Forget cached data for a room after it is created, changed or expires."""
+    room_cache.invalidate(room_id)
+    public_rooms_cache.invalidate()
 
 
 def create_room(
@@ -20,9 +120,9 @@ def create_room(
     is_private: bool = False,
     access_code: Optional[str] = None,
     timeout_minutes: int = 60,
-) -> Room:
-    with SessionLocal() as session:
-        port = get_next_available_port()
+) -> dict:
+    with db_session() as session:
+        port = GATEWAY_PORT
         room = Room(
             name=name,
             is_private=is_private,
@@ -40,63 +140,181 @@ def create_room(
         room_access = RoomAccess(room_id=room.id, user_id=admin_id, can_join=True)
         session.add(room_access)
         session.commit()
+        room_grants.add(admin_id, room.id)
+        room_data = room_to_dict(room)
 
-        threading.Thread(target=start_room_server, args=(room.port,)).start()
+    invalidate_room(room_data["id"])
+    room_cache.put(room_data["id"], room_data)
+    open_room(room_data["id"], room_data["expires_at"].timestamp())
 
-        print(
-            f"Room '{name}' created with ID: {room.id}, port: {port}, and timeout: {timeout_minutes} mins."
-        )
-        return room
+    print(
+        f"Room '{name}' created with ID: {room_data['id']}, port: {port}, and timeout: {timeout_minutes} mins."
+    )
+    return room_data
 
 
 def join_room(
     user_id: int, room_id: int, access_code: Optional[str] = None
-) -> Optional[Room]:
+) -> Optional[dict]:
     """Allows a user to join a room if they have permission or the correct access code."""
-    with SessionLocal() as session:
-        user = session.query(User).filter(User.id == user_id).first()
-        room = session.query(Room).filter(Room.id == room_id).first()
+    room = get_room(room_id)
 
-        if not room:
-            print("Room does not exist.")
-            return None
+    if not room:
+        print("Room does not exist.")
+        return None
 
-        if not room.is_active():
-            print("Room has timed out.")
-            return None
+    if room["expires_at"] <= datetime.now():
+        print("Room has timed out.")
+        return None
 
-        if room.is_private and not room.check_access_code(access_code or ""):
-            print("Incorrect access code for private room.")
-            return None
+    if (user_id, room_id) not in room_grants:
+        with db_session() as session:
+            room_access = (
+                session.query(RoomAccess)
+                .filter(RoomAccess.room_id == room_id, RoomAccess.user_id == user_id)
+                .first()
+            )
+            # An existing grant skips the bcrypt access-code check entirely.
+            if room_access is None or not room_access.can_join:
+                if room["is_private"]:
+                    room_row = session.get(Room, room_id)
+                    if not room_row.check_access_code(access_code or ""):
+                        print("Incorrect access code for private room.")
+                        return None
+
+            if room_access is None:
+                session.add(RoomAccess(room_id=room_id, user_id=user_id, can_join=True))
+                try:
+                    session.commit()
+                except IntegrityError:
+                    # A concurrent join inserted the same grant first.
+                    session.rollback()
+            if room_access is None or room_access.can_join:
+                room_grants.add(user_id, room_id)
+
+    # After a restart the gateway only learns about a room on its first join.
+    open_room(room_id, room["expires_at"].timestamp())
+    print(f"User {user_id} joined room '{room['name']}'.")
+    return room
+
+
+def has_room_access(user_id: int, room_id: int) -> bool:
+    """Whether a user may read and join an existing room: every public room, and
+    private rooms they hold a `can_join` grant for (see join_room)."""
+    room = get_room(room_id)
+    if not room:
+        return False
+    if not room["is_private"] or (user_id, room_id) in room_grants:
+        return True
+    with db_session() as session:
+        can_join = session.scalar(room_access_query(user_id, room_id))
+    if not can_join:
+        return False
+    room_grants.add(user_id, room_id)
+    return True
+
+
+async def fetch_room_access(user_id: int, room_id: int) -> bool:
+    """has_room_access on the async engine."""
+    room = await fetch_room(room_id)
+    if not room:
+        return False
+    if not room["is_private"] or (user_id, room_id) in room_grants:
+        return True
+    async with async_session() as session:
+        can_join = await session.scalar(room_access_query(user_id, room_id))
+    if not can_join:
+        return False
+    room_grants.add(user_id, room_id)
+    return True
+
+
+def room_access_query(user_id: int, room_id: int) -> Select:
+    return select(RoomAccess.can_join).where(
+        RoomAccess.room_id == room_id, RoomAccess.user_id == user_id
+    )
 
-        room_access = (
-            session.query(RoomAccess)
-            .filter(RoomAccess.room_id == room_id, RoomAccess.user_id == user_id)
-            .first()
+
+def load_active_room(room_id: int) -> Optional[float]:
+    """The room's expiry as a UNIX timestamp, or None if it is gone or expired."""
+    room = get_room(room_id)
+    if not room or room["expires_at"] <= datetime.now():
+        return None
+    return room["expires_at"].timestamp()
+
+
+def public_rooms_query(limit: int, after_id: int, now: datetime) -> Select:
+    return (
+        select(Room.id, Room.name, Room.admin_id, Room.expires_at)
+        .where(
+            Room.is_private == False,
+            Room.expires_at > now,
+            Room.id > after_id,
         )
+        .order_by(Room.id)
+        .limit(limit)
+    )
 
-        if not room_access:
-            room_access = RoomAccess(room_id=room_id, user_id=user_id, can_join=True)
-            session.add(room_access)
-            session.commit()
 
-        print(f"User '{user.username}' joined room '{room.name}'.")
-        return room
+def get_public_rooms(limit: int = ROOM_PAGE_SIZE, after_id: int = 0) -> list[dict]:
+    """Retrieves one page of active public rooms ordered by id, starting after
+    `after_id`. The first page is cached for ROOM_CACHE_TTL seconds."""
+    limit = max(1, min(limit, MAX_ROOM_PAGE_SIZE))
+    now = datetime.now()
+    rooms = public_rooms_cache.get(limit) if after_id == 0 else None
+    if rooms is not None:
+        return [room for room in rooms if room["expires_at"] > now]
+
+    with db_session() as session:
+        rows = session.execute(public_rooms_query(limit, after_id, now)).all()
+    rooms = [row._asdict() for row in rows]
+    if after_id == 0:
+        public_rooms_cache.put(limit, rooms)
+    print(f"Found {len(rooms)} active public rooms.")
+    return rooms
+
 
+async def fetch_public_rooms(
+    limit: int = ROOM_PAGE_SIZE, after_id: int = 0
+) -> list[dict]:
+    """get_public_rooms on the async engine."""
+    limit = max(1, min(limit, MAX_ROOM_PAGE_SIZE))
+    now = datetime.now()
+    rooms = public_rooms_cache.get(limit) if after_id == 0 else None
+    if rooms is not None:
+        return [room for room in rooms if room["expires_at"] > now]
 
-def get_public_rooms() -> list[Room]:
-    """Retrieves all active public rooms."""
-    with SessionLocal() as session:
-        rooms = session.query(Room).filter(Room.is_private == False).all()
-        print(f"Found {len(rooms)} public rooms.")
-        active_rooms = [room for room in rooms if room.is_active()]
-        print(f"Found {len(active_rooms)} active public rooms.")
-        return active_rooms
+    async with async_session() as session:
+        rows = (await session.execute(public_rooms_query(limit, after_id, now))).all()
+    rooms = [row._asdict() for row in rows]
+    if after_id == 0:
+        public_rooms_cache.put(limit, rooms)
+    return rooms
 
 
-def get_room(room_id: int) -> Optional[Room]:
-    with SessionLocal() as session:
-        room = session.query(Room).filter(Room.id == room_id).first()
-        if room:
-            print(f"Found room '{room.name}' with ID: {room.id}.")
+def get_room(room_id: int) -> Optional[dict]:
+    room = room_cache.get(room_id)
+    if room is not None:
         return room
+    with db_session() as session:
+        row = session.get(Room, room_id)
+        if not row:
+            return None
+        room = room_to_dict(row)
+    room_cache.put(room_id, room)
+    print(f"Found room '{room['name']}' with ID: {room['id']}.")
+    return room
+
+
+async def fetch_room(room_id: int) -> Optional[dict]:
+    """get_room on the async engine."""
+    room = room_cache.get(room_id)
+    if room is not None:
+        return room
+    async with async_session() as session:
+        row = await session.get(Room, room_id)
+        if not row:
+            return None
+        room = room_to_dict(row)
+    room_cache.put(room_id, room)
+    return room
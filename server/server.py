@@ -1,86 +1,395 @@
-import socket
+import asyncio
+import os
 import threading
-from typing import NoReturn
+import time
 import warnings
+from typing import Callable
+from protocol import (
+    RECV_BUFFER_SIZE,
+    Frame,
+    FrameDecoder,
+    FrameType,
+    encode_frame,
+)
+from outbound import FLUSH_INTERVAL, OutboundQueue, record_broadcast, record_write
+from registry import ClientRegistry
+import metrics
+from timer_wheel import TimerWheel
+from tokens import verify_token
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-LISTENER_LIMIT = 5
 HOST = "0.0.0.0"
-room_clients = {}
-lock = threading.Lock()
+# Every room is served from this one port, so creating a room never has to
+# find or probe a free port, and expiring one has nothing to release.
+GATEWAY_PORT = int(os.getenv("ROOM_GATEWAY_PORT", "5001"))
+API_PORT = int(os.getenv("API_PORT", "5000"))
+if GATEWAY_PORT == API_PORT:
+    raise ValueError("ROOM_GATEWAY_PORT must differ from the API port.")
+HANDSHAKE_TIMEOUT = 10
+ROOM_REAPER_TICK = float(os.getenv("ROOM_REAPER_TICK", "1"))
+room_clients: ClientRegistry["RoomConnection"] = ClientRegistry()
+open_rooms: set[int] = set()
+room_expiry = TimerWheel(ROOM_REAPER_TICK)
+# Called as message_store(user_id, room_id, content) for every relayed chat line;
+# must not block the event loop.
+message_store: Callable[[int, int, str], object] | None = None
+# Called as room_closed(room_id) on the gateway loop after a room expires.
+room_closed: Callable[[int], object] | None = None
+# Called as room_loader(room_id) in a worker thread for a HELLO naming a room
+# that is not open (e.g. after a restart); returns the room's expiry as a UNIX
+# timestamp if it is still active, else None.
+room_loader: Callable[[int], float | None] | None = None
+_restoring: dict[int, asyncio.Future] = {}
+# Called as room_access(user_id, room_id) in a worker thread once the room is
+# open; returns whether the user may join it (private rooms need a grant).
+# Without it every authenticated user may join any open room.
+room_access: Callable[[int, int], bool] | None = None
+# Whether open_room starts the gateway inside this process.
+embedded_gateway = True
 
+_gateway_thread: threading.Thread | None = None
+_gateway_lock = threading.Lock()
 
-def start_room_server(port: int) -> None:
-    room_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    room_server.bind((HOST, port))
-    room_server.listen(LISTENER_LIMIT)
-    print(f"Room server started on port {port}")
 
-    room_clients[port] = []
+metrics.gauge("chat_rooms_open", "Rooms accepting connections", lambda: len(open_rooms))
+metrics.gauge("chat_connections", "Connected room clients", lambda: len(room_clients))
+metrics.gauge(
+    "chat_room_clients",
+    "Connected clients per room",
+    lambda: {
+        metrics.labels(room=room_id): size
+        for room_id, size in room_clients.room_sizes().items()
+    },
+)
+metrics.histogram(
+    "chat_broadcast_seconds", "Time to queue one frame for every client in a room"
+)
+metrics.histogram(
+    "chat_delivery_seconds",
+    "Time from queueing a client's oldest pending frame to its batch being written",
+)
+metrics.counter("chat_bytes_received_total", "Bytes read from room clients")
+metrics.counter("chat_bytes_sent_total", "Bytes written to room clients")
+metrics.counter("chat_socket_send_errors_total", "Failed writes to room clients")
+metrics.counter(
+    "chat_slow_clients_dropped_total", "Clients dropped for a full outbound queue"
+)
 
+
+def open_room(room_id: int, expires_at: float | None = None) -> None:
+    """Accept connections for a room on the shared gateway, starting it if needed.
+
+    If `expires_at` (a UNIX timestamp) is given, the room is closed then. Does
+    nothing when the gateway runs in its own process (see gateway.py), which
+    restores rooms through room_loader instead.
+    """
+    if not embedded_gateway:
+        return
+    track_room(room_id, expires_at)
+    start_room_gateway()
+
+
+def track_room(room_id: int, expires_at: float | None = None) -> None:
+    open_rooms.add(room_id)
+    if expires_at is not None:
+        room_expiry.schedule(room_id, expires_at)
+
+
+def set_embedded_gateway(enabled: bool) -> None:
+    global embedded_gateway
+    embedded_gateway = enabled
+
+
+def set_message_store(store: Callable[[int, int, str], object] | None) -> None:
+    global message_store
+    message_store = store
+
+
+def set_room_closed_hook(hook: Callable[[int], object] | None) -> None:
+    global room_closed
+    room_closed = hook
+
+
+def set_room_loader(loader: Callable[[int], float | None] | None) -> None:
+    global room_loader
+    room_loader = loader
+
+
+def set_room_access_check(check: Callable[[int, int], bool] | None) -> None:
+    global room_access
+    room_access = check
+
+
+def start_room_gateway(port: int = GATEWAY_PORT) -> None:
+    """Start the room gateway event loop in a background thread (idempotent)."""
+    global _gateway_thread
+    with _gateway_lock:
+        if _gateway_thread is not None and _gateway_thread.is_alive():
+            return
+        _gateway_thread = threading.Thread(
+            target=run_room_gateway, args=(port,), daemon=True
+        )
+        _gateway_thread.start()
+
+
+def run_room_gateway(port: int = GATEWAY_PORT) -> None:
+    asyncio.run(serve_rooms(HOST, port))
+
+
+async def serve_rooms(host: str, port: int) -> None:
+    started = time.perf_counter()
+    gateway = await asyncio.start_server(handle_room_client, host, port)
+    print(
+        f"Room gateway started on port {port} in "
+        f"{(time.perf_counter() - started) * 1000:.1f} ms with {len(open_rooms)} "
+        "rooms open; other active rooms are restored on first join"
+    )
+    reaper = asyncio.create_task(reap_expired_rooms())
+    try:
+        async with gateway:
+            await gateway.serve_forever()
+    finally:
+        reaper.cancel()
+
+
+async def reap_expired_rooms() -> None:
     while True:
-        client, address = room_server.accept()
-        print(f"Client connected to room on port {port}: {address[0]}:{address[1]}")
-        threading.Thread(target=handle_room_client, args=(client, port)).start()
+        await asyncio.sleep(ROOM_REAPER_TICK)
+        for room_id in room_expiry.advance(time.time()):
+            try:
+                close_room(room_id, "This room has expired.")
+            except Exception as e:
+                print(f"Error closing room {room_id}: {e}")
+
+
+def close_room(room_id: int, reason: str) -> None:
+    """Stop accepting a room and disconnect its members with a final notice."""
+    open_rooms.discard(room_id)
+    room_expiry.cancel(room_id)
+    notice = encode_frame(FrameType.NOTICE, room_id, "SERVER", reason)
+    connections = room_clients.members(room_id)
+    for connection in connections:
+        if room_clients.remove(connection.id) is not None:
+            connection.close(notice)
+    print(f"Closed room {room_id} and disconnected {len(connections)} clients")
+    if room_closed is not None:
+        room_closed(room_id)
+
+
+class RoomConnection:
+    """A joined client, with a bounded outbound queue drained by its own task."""
+
+    def __init__(
+        self,
+        writer: asyncio.StreamWriter,
+        username: str,
+        room_id: int,
+        user_id: int | None = None,
+    ) -> None:
+        self.writer = writer
+        self.username = username
+        self.room_id = room_id
+        self.user_id = user_id
+        self.queue = OutboundQueue()
+        # When the oldest frame still waiting in the queue was put there.
+        self._queued_at = 0.0
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self.write_loop())
+        self.id = room_clients.add(room_id, self)
 
+    def send(self, frame: bytes) -> bool:
+        """Enqueue a frame without blocking; False if the client must be dropped."""
+        if not self.queue:
+            self._queued_at = time.perf_counter()
+        if not self.queue.put(frame):
+            return False
+        self._ready.set()
+        return True
 
-def handle_room_client(client: socket.socket, room_port: int) -> None:
-    """Handles messages for a client in a specific room."""
+    async def write_loop(self) -> None:
+        try:
+            while True:
+                await self._ready.wait()
+                if FLUSH_INTERVAL:
+                    await asyncio.sleep(FLUSH_INTERVAL)
+                self._ready.clear()
+                while frames := self.queue.take():
+                    queued_at = self._queued_at
+                    self.writer.writelines(frames)
+                    record_write()
+                    metrics.inc("chat_bytes_sent_total", sum(map(len, frames)))
+                    await self.writer.drain()
+                    # Covers the flush tick and the drain, which dominate
+                    # fan-out latency; chat_broadcast_seconds is only the enqueue.
+                    metrics.observe(
+                        "chat_delivery_seconds", time.perf_counter() - queued_at
+                    )
+        except (ConnectionError, OSError):
+            metrics.inc("chat_socket_send_errors_total")
+            remove_client(self)
+
+    def close(self, last_frame: bytes | None = None) -> None:
+        """Stop the writer and close the socket, optionally sending one last frame."""
+        self._task.cancel()
+        if last_frame is not None:
+            self.writer.write(last_frame)
+        self.writer.close()
+
+
+async def handle_room_client(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Reads the HELLO handshake frame and serves the client in that room.
+
+    The HELLO payload is the client's session token; relayed messages are stored
+    under the user id it was issued for.
+    """
+    address = writer.get_extra_info("peername")
+    decoder = FrameDecoder()
+    try:
+        frames = await asyncio.wait_for(read_frames(reader, decoder), HANDSHAKE_TIMEOUT)
+    except (asyncio.TimeoutError, ValueError):
+        writer.close()
+        return
+
+    hello = frames.pop(0) if frames else None
+    if hello is None or hello.type != FrameType.HELLO or not hello.sender:
+        writer.close()
+        return
+
+    room_id, username = hello.room, hello.sender
+    session = verify_token(hello.payload.decode("utf-8", "replace"))
+    if session is None:
+        reason = "Invalid or expired session"
+    elif not await ensure_room_open(room_id):
+        reason = f"Room {room_id} is not available"
+    elif not await may_join(session.user_id, room_id):
+        reason = f"Not allowed to join room {room_id}"
+    else:
+        reason = None
+    if reason is not None:
+        writer.write(encode_frame(FrameType.NOTICE, room_id, "SERVER", reason))
+        writer.close()
+        return
+
+    print(f"Client connected to room {room_id}: {address[0]}:{address[1]}")
+    connection = RoomConnection(writer, username, room_id, session.user_id)
+    send_notice_to_room(f"{username} joined the room {room_id}!", room_id)
+
+    try:
+        relay_frames(frames, connection)
+        await listen_for_room_messages(reader, decoder, connection)
+    except Exception as e:
+        print(f"Error handling client in room {room_id}: {e}")
+    finally:
+        remove_client(connection)
+
+
+async def ensure_room_open(room_id: int) -> bool:
+    """Whether a room is open, restoring it through room_loader if it is not.
+
+    Concurrent joins for the same room share a single load.
+    """
+    if room_id in open_rooms:
+        return True
+    if room_loader is None:
+        return False
+    pending = _restoring.get(room_id)
     try:
-        username = client.recv(2048).decode("utf-8")
-        if username:
-            with lock:
-                room_clients[room_port].append((username, client))
-            prompt_message = f"SERVER~{username} joined the room on port {room_port}!"
-            send_messages_to_room(prompt_message, room_port)
+        if pending is not None:
+            await pending
+            return room_id in open_rooms
+        started = time.perf_counter()
+        pending = asyncio.get_running_loop().run_in_executor(None, room_loader, room_id)
+        _restoring[room_id] = pending
+        try:
+            expires_at = await pending
+        finally:
+            del _restoring[room_id]
+    except Exception as e:
+        print(f"Error restoring room {room_id}: {e}")
+        return False
+    if expires_at is None or expires_at <= time.time():
+        return False
+    track_room(room_id, expires_at)
+    print(f"Restored room {room_id} in {(time.perf_counter() - started) * 1000:.1f} ms")
+    return True
 
-        listen_for_room_messages(client, username, room_port)
 
+async def may_join(user_id: int, room_id: int) -> bool:
+    """Whether room_access lets a user into an open room; False if it fails."""
+    if room_access is None:
+        return True
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, room_access, user_id, room_id
+        )
     except Exception as e:
-        print(f"Error handling client in room on port {room_port}: {e}")
-        remove_client(client, room_port)
+        print(f"Error checking access to room {room_id}: {e}")
+        return False
+
+
+async def read_frames(
+    reader: asyncio.StreamReader, decoder: FrameDecoder
+) -> list[Frame]:
+    """Reads until at least one complete frame is available; [] on EOF."""
+    while True:
+        data = await reader.read(RECV_BUFFER_SIZE)
+        if not data:
+            return []
+        metrics.inc("chat_bytes_received_total", len(data))
+        frames = decoder.feed(data)
+        if frames:
+            return frames
 
 
-def listen_for_room_messages(
-    client: socket.socket, username: str, room_port: int
+async def listen_for_room_messages(
+    reader: asyncio.StreamReader, decoder: FrameDecoder, connection: RoomConnection
 ) -> None:
     while True:
-        try:
-            message = client.recv(2048).decode("utf-8")
-            if message:
-                print(
-                    f"Received message from {username} in room on port {room_port}: {message}"
-                )
-                final_msg = f"{username}~{message}"
-                send_messages_to_room(final_msg, room_port)
-            else:
-                remove_client(client, room_port)
-                break
-        except Exception:
-            remove_client(client, room_port)
+        frames = await read_frames(reader, decoder)
+        if not frames:
             break
+        relay_frames(frames, connection)
 
 
-def send_messages_to_room(message: str, room_port: int) -> None:
-    """Send a message to all clients in a specific room."""
-    with lock:
-        for user in room_clients[room_port]:
-            try:
-                if user[1].getsockname()[1] == room_port:
-                    send_message_to_client(user[1], message)
-            except Exception:
-                remove_client(user[1], room_port)
+def relay_frames(frames: list[Frame], connection: RoomConnection) -> None:
+    username, room_id = connection.username, connection.room_id
+    for frame in frames:
+        if frame.type != FrameType.CHAT:
+            continue
+        print(f"Received message from {username} in room {room_id}: {frame.text}")
+        if message_store is not None and connection.user_id is not None:
+            message_store(connection.user_id, room_id, frame.text)
+        send_messages_to_room(
+            encode_frame(FrameType.CHAT, room_id, username, frame.payload), room_id
+        )
+
+
+def send_notice_to_room(notice: str, room_id: int) -> None:
+    send_messages_to_room(
+        encode_frame(FrameType.NOTICE, room_id, "SERVER", notice), room_id
+    )
+
+
+def send_messages_to_room(frame: bytes, room_id: int) -> None:
+    """Queue an encoded frame for every client in a specific room."""
+    started = time.perf_counter()
+    connections = room_clients.members(room_id)
+    record_broadcast(len(connections))
+    for connection in connections:
+        if not send_message_to_client(connection, frame):
+            print(f"Dropping slow client {connection.username} in room {room_id}")
+            metrics.inc("chat_slow_clients_dropped_total")
+            remove_client(connection)
+    metrics.observe("chat_broadcast_seconds", time.perf_counter() - started)
 
 
-def send_message_to_client(client: socket.socket, message: str) -> None:
-    client.sendall(message.encode())
+def send_message_to_client(connection: RoomConnection, frame: bytes) -> bool:
+    return connection.send(frame)
 
 
-def remove_client(client: socket.socket, room_port: int) -> None:
-    with lock:
-        for user in room_clients[room_port]:
-            if user[1] == client:
-                room_clients[room_port].remove(user)
-                break
-        client.close()
+def remove_client(connection: RoomConnection) -> None:
+    if room_clients.remove(connection.id) is not None:
+        connection.close()
@@ -0,0 +1,92 @@
+"""Hierarchical timing wheel for large numbers of coarse timeouts.
+
+Time is counted in whole ticks. Level 0 has one slot per tick and each higher
+level has slots `SLOTS` times wider, so scheduling and cancelling are O(1) and
+advancing costs O(1) per tick plus the timers that expire or move down a level.
+"""
+
+import threading
+import time
+from typing import Hashable
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4  # with 1s ticks: 64s, ~68min, ~73h, ~194 days
+
+
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, now: float | None = None) -> None:
+        self.tick = tick
+        self._current = self._to_tick(time.time() if now is None else now)
+        self._wheels: list[list[dict[Hashable, int]]] = [
+            [{} for _ in range(SLOTS)] for _ in range(LEVELS)
+        ]
+        self._timers: dict[Hashable, dict[Hashable, int]] = {}
+        self._due: dict[Hashable, None] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._timers) + len(self._due)
+
+    def _to_tick(self, when: float) -> int:
+        return int(when // self.tick)
+
+    def _place(self, key: Hashable, deadline: int) -> None:
+        if deadline <= self._current:
+            self._due[key] = None
+            return
+        # The lowest level whose wider slot still holds both now and the deadline.
+        for level in range(LEVELS):
+            shift = SLOT_BITS * (level + 1)
+            if deadline >> shift == self._current >> shift:
+                index = (deadline >> (SLOT_BITS * level)) & SLOT_MASK
+                break
+        else:
+            # Too far out: park in the top level's first slot, which is cascaded
+            # (and the timer re-placed) when the top level next wraps around.
+            level = LEVELS - 1
+            index = 0
+        slot = self._wheels[level][index]
+        slot[key] = deadline
+        self._timers[key] = slot
+
+    def schedule(self, key: Hashable, when: float) -> None:
+        """Fire `key` once `when` (a UNIX timestamp) has passed, replacing any
+        earlier schedule for the same key."""
+        with self._lock:
+            self._cancel(key)
+            self._place(key, self._to_tick(when))
+
+    def cancel(self, key: Hashable) -> None:
+        with self._lock:
+            self._cancel(key)
+
+    def _cancel(self, key: Hashable) -> None:
+        slot = self._timers.pop(key, None)
+        if slot is not None:
+            del slot[key]
+        self._due.pop(key, None)
+
+    def advance(self, now: float | None = None) -> list[Hashable]:
+        """Move the wheel up to `now` and return the keys that expired."""
+        target = self._to_tick(time.time() if now is None else now)
+        with self._lock:
+            while self._current < target:
+                self._current += 1
+                for level in range(LEVELS - 1, 0, -1):
+                    if self._current & ((1 << (SLOT_BITS * level)) - 1):
+                        continue
+                    index = (self._current >> (SLOT_BITS * level)) & SLOT_MASK
+                    slot = self._wheels[level][index]
+                    self._wheels[level][index] = {}
+                    for key, deadline in slot.items():
+                        del self._timers[key]
+                        self._place(key, deadline)
+                slot = self._wheels[0][self._current & SLOT_MASK]
+                self._wheels[0][self._current & SLOT_MASK] = {}
+                for key in slot:
+                    del self._timers[key]
+                self._due.update(dict.fromkeys(slot))
+            due, self._due = list(self._due), {}
+        return due
@@ -0,0 +1,60 @@
+"""Wall time per phase of the current API request.
+
+The API starts a request with start_request(); instrumented code then adds
+time to named phases (auth, db, crypto, serialize) and finish_request() hands
+back the totals. Outside a request, recording is a no-op. With SERVER_TIMING=1
+the API also returns the breakdown in a Server-Timing response header.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+# phase -> [seconds, calls]; one dict per request, shared with any worker
+# threads the request hands work to.
+_phases: ContextVar[dict[str, list] | None] = ContextVar("phases", default=None)
+
+
+def start_request() -> None:
+    _phases.set({})
+
+
+def finish_request() -> dict[str, list] | None:
+    phases = _phases.get()
+    _phases.set(None)
+    return phases
+
+
+def add(name: str, seconds: float) -> None:
+    phases = _phases.get()
+    if phases is None:
+        return
+    entry = phases.get(name)
+    if entry is None:
+        phases[name] = [seconds, 1]
+    else:
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - started)
+
+
+def server_timing_header(phases: dict[str, list], total: float) -> str:
+    """Phases as a Server-Timing header value, in milliseconds."""
+    entries = [
+        f'{name};dur={seconds * 1000:.2f};desc="{calls}x"'
+        for name, (seconds, calls) in phases.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
@@ -1,9 +1,16 @@
+import os
+import sys
 import socket
 import threading
 import flet as ft
 from typing import NoReturn
 import warnings
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+)
+from protocol import RECV_BUFFER_SIZE, FrameDecoder, FrameType, encode_frame
+
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 SERVER_PORT = 1234
@@ -38,7 +45,7 @@ def handle_commands(command: str, page: ft.Page, username_field: ft.TextField):
     elif command.startswith("/username "):
         new_username = command.split("/username ")[1].strip()
         if new_username:
-            client.sendall(f"/username {new_username}".encode())
+            client.sendall(encode_frame(FrameType.RENAME, payload=new_username))
             username_field.value = new_username  # Update input field with new username
         else:
             page.dialog = ft.AlertDialog(
@@ -74,7 +81,7 @@ def connect(
         page.update()
         return
 
-    client.sendall(current_username.encode())
+    client.sendall(encode_frame(FrameType.HELLO, sender=current_username))
     threading.Thread(
         target=listen_for_messages_from_server,
         args=(client, page, username_field),
@@ -101,7 +108,7 @@ def send_message(
             handle_commands(message, page, username_field)
         else:
             try:
-                client.sendall(message.encode())
+                client.sendall(encode_frame(FrameType.CHAT, payload=message))
                 add_message(page, f"[You] {message}", color="green")
             except Exception as e:
                 page.dialog = ft.AlertDialog(
@@ -121,29 +128,29 @@ def listen_for_messages_from_server(
     client: socket.socket, page: ft.Page, username_field: ft.TextField
 ) -> NoReturn:
     global current_username
+    decoder = FrameDecoder()
     while True:
         try:
-            message = client.recv(2048).decode("utf-8")
-            if message:
-                if message.startswith("SERVER~"):
-                    # Display server notifications in blue
-                    add_message(page, message.replace("SERVER~", ""), color="blue")
-                elif message.startswith("USERNAME_UPDATE~"):
-                    _, old_username, new_username = message.split("~")
-                    add_message(
-                        page,
-                        f"[SERVER] {old_username} changed username to {new_username}",
-                        "blue",
-                    )
-                    if old_username == current_username:
-                        current_username = new_username
-                        username_field.value = new_username  # Update the input field
-                        page.update()
-                else:
-                    username, content = message.split("~")
-                    color = "blue" if username == "SERVER" else "white"
-                    if username != current_username:
-                        add_message(page, f"[{username}] {content}", color)
+            data = client.recv(RECV_BUFFER_SIZE)
+            if data:
+                for frame in decoder.feed(data):
+                    if frame.type == FrameType.NOTICE:
+                        # Display server notifications in blue
+                        add_message(page, frame.text, color="blue")
+                    elif frame.type == FrameType.RENAME:
+                        old_username, new_username = frame.sender, frame.text
+                        add_message(
+                            page,
+                            f"[SERVER] {old_username} changed username to {new_username}",
+                            "blue",
+                        )
+                        if old_username == current_username:
+                            current_username = new_username
+                            # Update the input field
+                            username_field.value = new_username
+                            page.update()
+                    elif frame.sender != current_username:
+                        add_message(page, f"[{frame.sender}] {frame.text}", "white")
             else:
                 page.dialog = ft.AlertDialog(
                     title=ft.Text("Error: Received empty message")
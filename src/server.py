@@ -1,90 +1,167 @@
+import os
+import sys
 import socket
 import threading
+import time
 from typing import NoReturn
 import warnings
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+)
+from protocol import RECV_BUFFER_SIZE, Frame, FrameDecoder, FrameType, encode_frame
+from outbound import (
+    FLUSH_INTERVAL,
+    OutboundQueue,
+    record_broadcast,
+    record_write,
+    send_batch,
+)
+from registry import ClientRegistry
+
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 HOST = "0.0.0.0"
 PORT = 1234
 LISTENER_LIMIT = 5
-active_clients = []
-lock = threading.Lock()
+GLOBAL_ROOM = 0
 
 server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 
-def listen_for_messages(client: socket.socket, username: str) -> None:
+class ChatClient:
+    """A joined client whose bounded outbound queue is drained on its own thread."""
+
+    def __init__(self, client: socket.socket, username: str) -> None:
+        self.client = client
+        self.username = username
+        self.queue = OutboundQueue()
+        self.condition = threading.Condition()
+        self.closed = False
+        threading.Thread(target=self.run, daemon=True).start()
+        self.id = active_clients.add(GLOBAL_ROOM, self)
+
+    def send(self, frame: bytes) -> bool:
+        """Enqueue a frame without blocking; False if the client must be dropped."""
+        with self.condition:
+            if self.closed or not self.queue.put(frame):
+                return False
+            self.condition.notify()
+        return True
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.client.close()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+            if FLUSH_INTERVAL:
+                time.sleep(FLUSH_INTERVAL)
+            with self.condition:
+                frames = self.queue.take()
+            try:
+                send_batch(self.client, frames)
+                record_write()
+            except OSError:
+                remove_client(self)
+                return
+
+
+active_clients: ClientRegistry[ChatClient] = ClientRegistry()
+
+
+def listen_for_messages(
+    chat_client: ChatClient, decoder: FrameDecoder, frames: list[Frame]
+) -> None:
     while True:
         try:
-            message = client.recv(2048).decode("utf-8")
-            if message:
-                if message.startswith("/username "):
-                    new_username = message.split(" ", 1)[1]
-                    update_username(client, username, new_username)
-                    username = new_username
-                else:
-                    final_msg = username + "~" + message
-                    send_messages_to_all(final_msg)
+            for frame in frames:
+                handle_frame(chat_client, frame)
+            data = chat_client.client.recv(RECV_BUFFER_SIZE)
+            if data:
+                frames = decoder.feed(data)
             else:
-                remove_client(client)
+                remove_client(chat_client)
                 break
         except:
-            remove_client(client)
+            remove_client(chat_client)
             break
 
 
-def update_username(
-    client: socket.socket, old_username: str, new_username: str
-) -> None:
-    with lock:
-        for idx, (username, client_socket) in enumerate(active_clients):
-            if client_socket == client:
-                active_clients[idx] = (new_username, client)
-                break
-    notification = f"SERVER~{old_username} changed their name to {new_username}"
+def handle_frame(chat_client: ChatClient, frame: Frame) -> None:
+    if frame.type == FrameType.RENAME:
+        update_username(chat_client, frame.text)
+    elif frame.type == FrameType.CHAT:
+        send_messages_to_all(
+            encode_frame(
+                FrameType.CHAT, sender=chat_client.username, payload=frame.payload
+            )
+        )
+
+
+def update_username(chat_client: ChatClient, new_username: str) -> None:
+    old_username = chat_client.username
+    chat_client.username = new_username
+    notification = encode_frame(
+        FrameType.RENAME, sender=old_username, payload=new_username
+    )
     send_messages_to_all(notification)
 
 
-def send_message_to_client(client: socket.socket, message: str) -> None:
-    client.sendall(message.encode())
+def send_message_to_client(chat_client: ChatClient, frame: bytes) -> bool:
+    return chat_client.send(frame)
 
 
-def send_messages_to_all(message: str) -> None:
-    with lock:
-        for user in active_clients:
-            try:
-                send_message_to_client(user[1], message)
-            except:
-                remove_client(user[1])
+def send_messages_to_all(frame: bytes) -> None:
+    recipients = active_clients.members(GLOBAL_ROOM)
+    record_broadcast(len(recipients))
+    for chat_client in recipients:
+        if not send_message_to_client(chat_client, frame):
+            remove_client(chat_client)
 
 
-def remove_client(client: socket.socket) -> None:
-    with lock:
-        for user in active_clients:
-            if user[1] == client:
-                active_clients.remove(user)
-                break
-        client.close()
+def remove_client(chat_client: ChatClient) -> None:
+    if active_clients.remove(chat_client.id) is not None:
+        chat_client.close()
 
 
 def client_handler(client: socket.socket) -> None:
+    decoder = FrameDecoder()
     while True:
         try:
-            username = client.recv(2048).decode("utf-8")
-            if username:
-                with lock:
-                    active_clients.append((username, client))
-                prompt_message = "SERVER~" + f"{username} joined the chat!"
+            data = client.recv(RECV_BUFFER_SIZE)
+            if not data:
+                client.close()
+                return
+            frames = decoder.feed(data)
+            if frames:
+                hello = frames[0]
+                if hello.type != FrameType.HELLO or not hello.sender:
+                    print("Client username is empty")
+                    client.close()
+                    return
+                chat_client = ChatClient(client, hello.sender)
+                prompt_message = encode_frame(
+                    FrameType.NOTICE,
+                    sender="SERVER",
+                    payload=f"{hello.sender} joined the chat!",
+                )
                 send_messages_to_all(prompt_message)
                 break
-            else:
-                print("Client username is empty")
         except:
-            remove_client(client)
+            client.close()
             return
 
-    threading.Thread(target=listen_for_messages, args=(client, username)).start()
+    threading.Thread(
+        target=listen_for_messages, args=(chat_client, decoder, frames[1:])
+    ).start()
 
 
 def main() -> NoReturn: